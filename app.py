@@ -1,12 +1,13 @@
-from flask import Flask, request, render_template, jsonify, send_file, session, redirect, url_for, flash
+from flask import Flask, request, render_template, jsonify, send_file, session, redirect, url_for, flash, g, Response
 import os
 import base64
 import requests
-from werkzeug.utils import secure_filename
+from requests.adapters import HTTPAdapter
 import json
-from PIL import Image
+from PIL import Image, ImageOps, ImageFilter, ImageStat, features
 import io
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 import logging
 from docx import Document
 from docx.shared import Inches, Pt
@@ -14,9 +15,29 @@ from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 import tempfile
+import zipfile
+import gzip
+import shutil
+import atexit
 import re
-import psycopg2
+import math
+import hashlib
+import sqlite3
+from psycopg2 import pool as pg_pool
+import threading
+import time
+import queue
+import uuid
+import random
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
 from functools import wraps
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，usage.log 轮转时不加跨进程锁
+    fcntl = None
 import config  # 导入配置文件
 import bcrypt
 
@@ -38,30 +59,178 @@ logger = logging.getLogger(__name__)
 # Usage Log File
 USAGE_LOG_FILE = config.USAGE_LOG_FILE
 
-# 用户历史记录目录
+# 旧版用户历史记录目录 (migrate_history.py 从这里导入)
 USER_HISTORY_FOLDER = config.USER_HISTORY_FOLDER
 
 # 创建上传目录
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# 创建用户历史记录目录
-os.makedirs(USER_HISTORY_FOLDER, exist_ok=True)
-
-# 转换次数统计文件
+# 旧版转换次数统计文件 (首次启动时导入计数器数据库)
 STATS_FILE = config.STATS_FILE
 
 # 支持的图片格式
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 
+# 支持的文档格式 (按页栅格化后逐页识别)
+PDF_EXTENSIONS = {'pdf'}
+
 # --- Database & Auth Functions ---
 
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(DB_URI)
+class DatabasePool:
+    """PostgreSQL 连接池：有界等待借出、空闲连接健康检查、统计信息"""
+
+    def __init__(self, dsn, min_size, max_size, checkout_timeout, health_check_interval, connect_timeout):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.connect_timeout = connect_timeout
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+        self._in_use = 0
+        self._stats = {
+            'checkouts': 0,
+            'checkout_timeouts': 0,
+            'connect_errors': 0,
+            'health_check_failures': 0,
+            'discarded': 0,
+            'total_wait_ms': 0.0
+        }
+
+    def _get_pool(self):
+        # gunicorn 等预派生模型下，每个工作进程必须持有自己的连接池
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = pg_pool.ThreadedConnectionPool(
+                    self.min_size, self.max_size, self.dsn,
+                    connect_timeout=self.connect_timeout
+                )
+                self._pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(self.max_size)
+                self._last_used = {}
+                self._in_use = 0
+            return self._pool
+
+    def _is_healthy(self, conn):
+        """连接空闲超过检查间隔时执行 SELECT 1 确认可用"""
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """借出连接，超过 checkout_timeout 仍无空闲连接时返回 None"""
+        start = time.monotonic()
+        try:
+            pool = self._get_pool()
+        except Exception as e:
+            with self._lock:
+                self._stats['connect_errors'] += 1
+            logger.error(f"Database pool creation error: {e}")
+            return None
+
+        slots = self._slots
+        if not slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._stats['checkout_timeouts'] += 1
+            logger.error(f"Database pool exhausted, waited {self.checkout_timeout}s")
+            return None
+
+        try:
+            # 数据库重启后池中的空闲连接可能全部失效：逐个丢弃，最后新建的连接不需要检查
+            for _ in range(self.max_size + 1):
+                conn = pool.getconn()
+                if self._is_healthy(conn):
+                    break
+                with self._lock:
+                    self._stats['health_check_failures'] += 1
+                    self._stats['discarded'] += 1
+                    self._last_used.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+            else:
+                raise RuntimeError("连接健康检查连续失败")
+        except Exception as e:
+            slots.release()
+            with self._lock:
+                self._stats['connect_errors'] += 1
+            logger.error(f"Database connection error: {e}")
+            return None
+
+        with self._lock:
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+            self._stats['total_wait_ms'] += (time.monotonic() - start) * 1000
         return conn
-    except Exception as e:
-        logger.error(f"Database connection error: {e}")
-        return None
+
+    def putconn(self, conn):
+        """归还连接；已断开或处于异常事务状态的连接直接丢弃"""
+        if conn is None:
+            return
+        pool = self._pool
+        if pool is None or self._pid != os.getpid():
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+        discard = bool(conn.closed)
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        try:
+            pool.putconn(conn, close=discard)
+        except Exception as e:
+            logger.error(f"Failed to return database connection: {e}")
+        with self._lock:
+            if discard:
+                self._stats['discarded'] += 1
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._in_use = max(0, self._in_use - 1)
+        self._slots.release()
+
+    def get_stats(self):
+        """返回连接池统计信息（用于 /stats/details）"""
+        with self._lock:
+            stats = dict(self._stats)
+            total_wait_ms = stats.pop('total_wait_ms')
+            checkouts = stats['checkouts']
+            stats['avg_wait_ms'] = round(total_wait_ms / checkouts, 2) if checkouts else 0.0
+            stats['in_use'] = self._in_use
+            stats['idle'] = len(self._pool._pool) if self._pool is not None else 0
+            stats['min_size'] = self.min_size
+            stats['max_size'] = self.max_size
+        return stats
+
+db_pool = DatabasePool(
+    DB_URI,
+    min_size=config.DB_POOL_MIN_SIZE,
+    max_size=config.DB_POOL_MAX_SIZE,
+    checkout_timeout=config.DB_POOL_TIMEOUT,
+    health_check_interval=config.DB_POOL_HEALTH_CHECK_INTERVAL,
+    connect_timeout=config.DB_CONNECT_TIMEOUT
+)
+
+def get_db_connection():
+    return db_pool.getconn()
+
+def release_db_connection(conn):
+    db_pool.putconn(conn)
 
 def check_login(email, password):
     conn = get_db_connection()
@@ -119,7 +288,59 @@ def check_login(email, password):
         return False, f"登录处理错误: {str(e)}"
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
+
+class TTLCache:
+    """线程安全、有容量上限的 TTL 缓存（进程内，LRU 淘汰）"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+# 会话验证缓存: email -> (auth 表是否存在, user 表 role)
+session_cache = TTLCache(config.SESSION_CACHE_MAX_SIZE, config.SESSION_CACHE_TTL)
+
+def invalidate_user_session_cache(email):
+    """立即使某个用户的会话验证缓存失效（角色变更、登录、登出时调用）"""
+    session_cache.invalidate(email)
 
 def login_required(f):
     @wraps(f)
@@ -129,122 +350,1001 @@ def login_required(f):
         
         # 验证用户是否仍然存在于数据库中且账户已激活
         user_email = session['user_email']
-        conn = get_db_connection()
-        if not conn:
-            # 数据库连接失败，清除会话并跳转登录
-            session.clear()
-            flash("数据库连接失败，请重新登录")
-            return redirect(url_for('login'))
-        
-        try:
-            cur = conn.cursor()
-            # 检查用户是否存在于 auth 表
-            cur.execute("SELECT email FROM auth WHERE email = %s", (user_email,))
-            auth_exists = cur.fetchone()
-            
-            if not auth_exists:
-                # 用户已被删除，清除会话
-                session.clear()
-                flash("您的账户已被删除，请联系管理员")
-                return redirect(url_for('login'))
-            
-            # 检查用户在 user 表中的角色状态
-            cur.execute("SELECT role FROM \"user\" WHERE email = %s", (user_email,))
-            user_info = cur.fetchone()
-            
-            if not user_info:
-                # 用户信息不完整
+        user_status = session_cache.get(user_email)
+        if user_status is None:
+            conn = get_db_connection()
+            if not conn:
+                # 数据库连接失败，清除会话并跳转登录
                 session.clear()
-                flash("用户信息不完整，请联系管理员")
+                flash("数据库连接失败，请重新登录")
                 return redirect(url_for('login'))
             
-            role = user_info[0]
-            if role == "pending":
-                # 账户已被设为待审核状态
+            try:
+                cur = conn.cursor()
+                # 单次查询同时检查 auth 表存在性和 user 表角色
+                cur.execute(
+                    "SELECT u.role FROM auth a LEFT JOIN \"user\" u ON u.email = a.email WHERE a.email = %s",
+                    (user_email,)
+                )
+                row = cur.fetchone()
+                user_status = (row is not None, row[0] if row else None)
+                session_cache.set(user_email, user_status)
+            except Exception as e:
+                logger.error(f"Session validation error: {e}")
                 session.clear()
-                flash("您的账户已被设为待审核状态，请联系管理员")
+                flash("会话验证失败，请重新登录")
                 return redirect(url_for('login'))
-                
-        except Exception as e:
-            logger.error(f"Session validation error: {e}")
+            finally:
+                if conn:
+                    release_db_connection(conn)
+        
+        auth_exists, role = user_status
+        if not auth_exists:
+            # 用户已被删除，清除会话
             session.clear()
-            flash("会话验证失败，请重新登录")
+            flash("您的账户已被删除，请联系管理员")
+            return redirect(url_for('login'))
+        
+        if not role:
+            # 用户信息不完整
+            session.clear()
+            flash("用户信息不完整，请联系管理员")
             return redirect(url_for('login'))
-        finally:
-            if conn:
-                conn.close()
         
+        if role == "pending":
+            # 账户已被设为待审核状态
+            session.clear()
+            flash("您的账户已被设为待审核状态，请联系管理员")
+            return redirect(url_for('login'))
+        
+        g.user_role = role
         return f(*args, **kwargs)
     return decorated_function
 
-# --- Logging Functions ---
+def check_user_rate(cost=1):
+    """按用户角色的令牌桶限流，超出配额时返回 429 响应，否则返回 None（需在 login_required 之后调用）"""
+    rate = config.ADMIN_RATE_LIMIT if g.user_role == 'admin' else config.USER_RATE_LIMIT
+    wait_seconds = user_limiter.acquire([(f"user:{session['user_email']}", rate, cost)])
+    if not wait_seconds:
+        return None
+    
+    retry_after = max(1, math.ceil(wait_seconds))
+    user_rate_stats.add('rejected')
+    logger.info(f"用户 {session['user_email']} 请求过于频繁，需等待 {retry_after} 秒")
+    response = jsonify({'success': False, 'error': f'请求过于频繁，请 {retry_after} 秒后再试', 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
 
-def log_user_action(email, success):
+def rate_limited(f):
+    """每次请求消耗一次转换配额"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        limited = check_user_rate()
+        if limited is not None:
+            return limited
+        return f(*args, **kwargs)
+    return decorated_function
+
+# --- Image Input ---
+
+class UploadedImage:
+    """一张上传的图片：原始字节只解码一次，在图片优化、API调用和历史记录之间共享"""
+
+    def __init__(self, data=None, image=None):
+        self._data = data
+        self._image = image
+
+    @classmethod
+    def from_base64(cls, image_data):
+        # 处理 base64 数据 (可能包含 data:image/xxx;base64, 前缀)
+        if ',' in image_data:
+            image_data = image_data.split(',', 1)[1]
+        return cls(data=base64.b64decode(image_data))
+
+    @property
+    def data(self):
+        """原始图片字节；由 PIL 图片构造时按需编码为 PNG"""
+        if self._data is None:
+            output = io.BytesIO()
+            self._image.save(output, format='PNG')
+            self._data = output.getvalue()
+        return self._data
+
+    def open_header(self):
+        """只读取文件头并检查尺寸，不解码像素"""
+        img = Image.open(io.BytesIO(self.data))
+        # 解码前先检查尺寸，防止超大图片耗尽内存
+        if img.width * img.height > config.IMAGE_MAX_PIXELS:
+            raise ValueError(f"图片尺寸过大 ({img.width}x{img.height})")
+        return img
+
+    @property
+    def image(self):
+        """解码后的 PIL 图片（只解码一次，调用方不得原地修改）"""
+        if self._image is None:
+            img = self.open_header()
+            img.load()
+            self._image = img
+        return self._image
+
+    def release(self):
+        """释放解码后的图片，只保留原始字节"""
+        if self._data is not None:
+            self._image = None
+
+    def to_base64(self):
+        return base64.b64encode(self.data).decode('utf-8')
+
+    def digest(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+def validate_image(image, decode=True):
+    """确认图片可以解码且尺寸在限制内，返回错误信息，合法时返回 None；decode=False 时只检查文件头"""
     try:
-        timestamp = datetime.now().isoformat()
-        status = "Success" if success else "Failed"
-        log_entry = f"{timestamp}|{email}|{status}\n"
-        
-        with open(USAGE_LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(log_entry)
+        if decode:
+            image.image
+        else:
+            image.open_header()
+    except ValueError as e:
+        return str(e)
     except Exception as e:
-        logger.error(f"Failed to write usage log: {e}")
+        logger.warning(f"图片解码失败: {e}")
+        return '无法识别的图片文件'
+    return None
+
+def as_uploaded_image(image_data):
+    """兼容旧接口：base64 字符串转换为 UploadedImage"""
+    if isinstance(image_data, UploadedImage):
+        return image_data
+    return UploadedImage.from_base64(image_data)
+
+def is_binary_request():
+    """请求体是否为原始图片二进制 (Content-Type: image/* 或 application/octet-stream)"""
+    return request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream'
+
+def read_request_image():
+    """从请求中读取图片：multipart 文件、原始二进制请求体或 JSON base64，返回 (UploadedImage, 错误信息)"""
+    if request.files:
+        file = request.files.get('file')
+        if not file or file.filename == '':
+            return None, '没有选择文件'
+        if not allowed_file(file.filename):
+            return None, '不支持的文件格式'
+        image = UploadedImage(data=file.read())
+    elif is_binary_request():
+        data = request.get_data(cache=False)
+        if not data:
+            return None, '没有图片数据'
+        image = UploadedImage(data=data)
+    else:
+        data = request.get_json(silent=True) or {}
+        image_data = data.get('image')
+        if not image_data:
+            return None, '没有图片数据'
+        image = UploadedImage.from_base64(image_data)
+    
+    error = validate_image(image)
+    if error:
+        return None, error
+    return image, None
+
+# --- Logging Functions ---
+
+class BackgroundWriter:
+    """后台批量写入基类：请求线程只把条目放进有界队列，每个工作进程一个后台线程攒满 batch_size 条
+    或等待 flush_interval 秒后调用子类的 _flush(batch)；进程退出时 close() 写完队列中剩余的条目
+
+    enqueue_timeout 为 0 时队列满直接丢弃，否则请求线程最多等待该秒数 (反压)，仍然满才丢弃。
+    """
+
+    thread_name = 'background-writer'
+    close_timeout = 5
+
+    def __init__(self, batch_size, flush_interval, queue_size, enqueue_timeout=0, extra_stats=()):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'written': 0, 'dropped': 0, 'blocked': 0, 'flushes': 0, 'errors': 0,
+            'last_flush_ms': 0, 'max_flush_ms': 0, 'total_flush_ms': 0
+        }
+        self.stats.update((name, 0) for name in extra_stats)
+
+    def _ensure_thread(self):
+        # 写入线程按进程启动（gunicorn fork 之后）
+        with self._lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+            return self._queue
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def write(self, item):
+        """放入写入队列，队列满且等待超时时返回 False"""
+        item_queue = self._ensure_thread()
+        try:
+            item_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            if not self.enqueue_timeout:
+                self._count('dropped')
+                return False
+            self._count('blocked')
+        try:
+            item_queue.put(item, timeout=self.enqueue_timeout)
+            return True
+        except queue.Full:
+            self._count('dropped')
+            return False
+
+    def _run(self):
+        item_queue = self._queue
+        while True:
+            item = item_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = item_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            started = time.monotonic()
+            self._flush(batch)
+            elapsed = round((time.monotonic() - started) * 1000, 1)
+            with self._lock:
+                self.stats['flushes'] += 1
+                self.stats['last_flush_ms'] = elapsed
+                self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], elapsed)
+                self.stats['total_flush_ms'] += elapsed
+            if stop:
+                return
+
+    def _flush(self, batch):
+        """写入一批条目，自行计数 written/errors，不抛出异常"""
+        raise NotImplementedError
+
+    def close(self, timeout=None):
+        """写入队列中剩余的条目（进程退出时调用）"""
+        timeout = self.close_timeout if timeout is None else timeout
+        with self._lock:
+            running = self._queue is not None and self._pid == os.getpid()
+        if running:
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['queue_depth'] = self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+        stats['avg_flush_ms'] = round(stats.pop('total_flush_ms') / stats['flushes'], 1) if stats['flushes'] else 0
+        return stats
 
-def save_user_history(email, image_base64, latex_result, success):
+class UsageEventWriter(BackgroundWriter):
+    """使用事件后台写入；磁盘卡住时宁可丢弃统计事件，也不阻塞请求
+
+    - usage.log：原有的 时间|邮箱|状态 格式（首页使用记录），超过 log_max_bytes 后轮转为 usage.log.1 ... usage.log.N
+    - {events_folder}/usage-YYYY-MM-DD.jsonl：每次转换的结构化事件（耗时、图片大小、tokens、缓存命中），
+      按写入日期分文件，之前日期的文件压缩为 .gz
     """
-    保存用户历史记录：上传的图片和AI返回的结果
-    目录结构: user_history/{用户邮箱}/{时间戳}/
-        - image.png (上传的图片)
-        - result.txt (AI返回的LaTeX代码或错误信息)
-        - metadata.json (元数据)
+
+    thread_name = 'usage-event-writer'
+
+    def __init__(self, log_path, events_folder, batch_size, flush_interval, queue_size, log_max_bytes, log_backup_count):
+        super().__init__(batch_size, flush_interval, queue_size, extra_stats=('compressed_files', 'log_rotations'))
+        self.log_path = log_path
+        self.events_folder = events_folder
+        self.log_max_bytes = log_max_bytes
+        self.log_backup_count = max(1, log_backup_count)
+        self._day = None
+
+    def _log_size(self):
+        try:
+            return os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return 0
+
+    def _rotate_log(self):
+        """usage.log 超过 log_max_bytes 时依次改名为 .1 ... .N，最旧的被覆盖；多个工作进程由文件锁保证只轮转一次"""
+        if not self.log_max_bytes or self._log_size() < self.log_max_bytes:
+            return
+        with open(f"{self.log_path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # 等锁期间其他进程可能已经轮转
+            if self._log_size() < self.log_max_bytes:
+                return
+            for i in range(self.log_backup_count - 1, 0, -1):
+                if os.path.exists(f"{self.log_path}.{i}"):
+                    os.replace(f"{self.log_path}.{i}", f"{self.log_path}.{i + 1}")
+            os.replace(self.log_path, f"{self.log_path}.1")
+        self._count('log_rotations')
+
+    def _flush(self, batch):
+        try:
+            self._rotate_log()
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(
+                    f"{event['timestamp']}|{event['email']}|{'Success' if event['success'] else 'Failed'}\n" for event in batch
+                ))
+            
+            day = datetime.now().strftime('%Y-%m-%d')
+            if day != self._day:
+                os.makedirs(self.events_folder, exist_ok=True)
+                self._compress_before(day)
+                self._day = day
+            data = ''.join(json.dumps(event, ensure_ascii=False) + '\n' for event in batch).encode('utf-8')
+            # 一次 O_APPEND 写入整批，多个工作进程写同一个文件时行不会交错
+            fd = os.open(os.path.join(self.events_folder, f"usage-{day}.jsonl"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            
+            self._count('written', len(batch))
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Failed to write usage log: {e}")
+
+    def _compress_before(self, day):
+        """把 day 之前日期的事件文件压缩为 .gz（多个进程同时处理时先改名认领）"""
+        for name in os.listdir(self.events_folder):
+            match = re.fullmatch(r'usage-(\d{4}-\d{2}-\d{2})\.jsonl', name)
+            if not match or match.group(1) >= day:
+                continue
+            path = os.path.join(self.events_folder, name)
+            claimed = f"{path}.{os.getpid()}.compressing"
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                continue
+            # 已有 .gz 时追加为新的 gzip 成员，解压时自动拼接
+            with open(claimed, 'rb') as src, gzip.open(f"{path}.gz", 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(claimed)
+            self._count('compressed_files')
+
+usage_writer = UsageEventWriter(
+    USAGE_LOG_FILE,
+    config.USAGE_EVENTS_FOLDER,
+    batch_size=config.USAGE_EVENT_BATCH_SIZE,
+    flush_interval=config.USAGE_EVENT_FLUSH_INTERVAL,
+    queue_size=config.USAGE_EVENT_QUEUE_SIZE,
+    log_max_bytes=config.USAGE_LOG_MAX_BYTES,
+    log_backup_count=config.USAGE_LOG_BACKUP_COUNT
+)
+atexit.register(usage_writer.close)
+
+def log_user_action(email, success, details=None):
+    """记录一次转换的使用事件（后台批量写入）；details 为 usage_details 整理的附加字段"""
+    event = {'timestamp': datetime.now().isoformat(), 'email': email, 'success': bool(success)}
+    if details:
+        event.update(details)
+    usage_writer.write(event)
+
+class HistoryStore:
+    """用户历史记录：元数据和结果保存在 SQLite 索引中，图片按内容哈希去重后追加写入 pack 文件
+
+    pack 文件只追加不修改，每条记录为 4 字节魔数 + 32 字节 SHA-256 + 8 字节长度 + 图片内容，
+    索引丢失时可以扫描 pack 文件重建。写入在 SQLite 写事务内进行，多个工作进程不会同时追加同一个 pack。
     """
-    try:
-        # 使用邮箱前缀作为文件夹名（处理特殊字符）
-        safe_email = email.replace('@', '_at_').replace('.', '_')
+
+    PACK_MAGIC = b'HPK1'
+    HEADER_SIZE = 44
+
+    def __init__(self, db_path, pack_folder, pack_max_bytes):
+        self.db_path = db_path
+        self.pack_folder = pack_folder
+        self.pack_max_bytes = pack_max_bytes
+        self._schema_ready = False
+        self.fts_enabled = False
+        self._lock = threading.Lock()
+        self.stats = {'stores': 0, 'dedup_hits': 0, 'errors': 0}
+
+    def _conn(self):
+        conn = get_sqlite_connection(self.db_path)
+        if not self._schema_ready:
+            os.makedirs(self.pack_folder, exist_ok=True)
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    email TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    success INTEGER NOT NULL,
+                    latex TEXT NOT NULL,
+                    image_hash TEXT,
+                    legacy_path TEXT UNIQUE,
+                    thumbnail INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_history_email ON history (email, id);
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    pack INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    refs INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS history_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_pack ON blobs (pack, offset)")
+            # 每个 pack 中仍被引用的字节数 (含记录头)，压缩时据此选择 pack，不必扫描 blobs 表
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'pack_stats'").fetchone():
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("CREATE TABLE IF NOT EXISTS pack_stats (pack INTEGER PRIMARY KEY, live_bytes INTEGER NOT NULL)")
+                    conn.execute(
+                        "INSERT OR REPLACE INTO pack_stats (pack, live_bytes) SELECT pack, SUM(size) + COUNT(*) * ? FROM blobs GROUP BY pack",
+                        (self.HEADER_SIZE,)
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            # 早期版本的 history 表没有 thumbnail 列
+            if 'thumbnail' not in [row[1] for row in conn.execute("PRAGMA table_info(history)")]:
+                conn.execute("ALTER TABLE history ADD COLUMN thumbnail INTEGER NOT NULL DEFAULT 0")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_history_originals ON history (created_at) WHERE thumbnail = 0 AND image_hash IS NOT NULL"
+            )
+            self.fts_enabled = self._ensure_fts(conn)
+            self._schema_ready = True
+        return conn
+
+    def _ensure_fts(self, conn):
+        """创建 LaTeX 全文索引 (trigram 分词支持任意子串搜索，如 "frac" 或 "x^2")
+
+        trigram 分词需要 SQLite 3.34+，不支持时回滚并返回 False，搜索退回逐行 instr() 匹配 (同样不区分大小写)。
+        """
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_fts'").fetchone():
+            return True
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                    latex, content='history', content_rowid='id', tokenize='trigram'
+                )
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                    INSERT INTO history_fts (rowid, latex) VALUES (new.id, new.latex);
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                    INSERT INTO history_fts (history_fts, rowid, latex) VALUES ('delete', old.id, old.latex);
+                END
+            """)
+            conn.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError as e:
+            conn.execute("ROLLBACK")
+            logger.warning(f"SQLite 不支持 FTS5 trigram 全文索引 ({sqlite3.sqlite_version})，历史搜索使用逐行匹配: {e}")
+            return False
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def pack_path(self, pack):
+        return os.path.join(self.pack_folder, f"pack-{pack:06d}.pack")
+
+    def _store_blob(self, conn, data):
+        """在写事务内保存图片，相同内容只保存一份，返回哈希"""
+        digest = hashlib.sha256(data)
+        image_hash = digest.hexdigest()
+        if conn.execute("UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (image_hash,)).rowcount:
+            self._count('dedup_hits')
+            return image_hash
         
-        # 创建时间戳文件夹
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        pack, offset = self._append(conn, digest.digest(), data)
+        conn.execute(
+            "INSERT INTO blobs (hash, pack, offset, size, refs) VALUES (?, ?, ?, ?, 1)",
+            (image_hash, pack, offset, len(data))
+        )
+        self._add_live_bytes(conn, pack, len(data) + self.HEADER_SIZE)
+        return image_hash
+
+    @staticmethod
+    def _add_live_bytes(conn, pack, amount):
+        conn.execute(
+            "INSERT INTO pack_stats (pack, live_bytes) VALUES (?, ?) "
+            "ON CONFLICT (pack) DO UPDATE SET live_bytes = live_bytes + excluded.live_bytes",
+            (pack, amount)
+        )
+
+    def _current_pack(self, conn):
+        row = conn.execute("SELECT value FROM history_meta WHERE key = 'current_pack'").fetchone()
+        return int(row[0]) if row else 1
+
+    def _append(self, conn, digest, data):
+        """在写事务内把图片追加到当前 pack (超过大小上限时新建)，返回 (pack, 数据偏移)"""
+        pack = self._current_pack(conn)
+        path = self.pack_path(pack)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size and size + self.HEADER_SIZE + len(data) > self.pack_max_bytes:
+            pack += 1
+            path = self.pack_path(pack)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+        conn.execute("INSERT OR REPLACE INTO history_meta (key, value) VALUES ('current_pack', ?)", (str(pack),))
         
-        # 创建用户目录和时间戳子目录
-        user_folder = os.path.join(USER_HISTORY_FOLDER, safe_email)
-        history_folder = os.path.join(user_folder, timestamp)
-        os.makedirs(history_folder, exist_ok=True)
+        with open(path, 'ab') as f:
+            f.write(self.PACK_MAGIC + digest + len(data).to_bytes(8, 'big'))
+            f.write(data)
+        return pack, size + self.HEADER_SIZE
+
+    def _release_blob(self, conn, image_hash):
+        """在写事务内减少图片引用，不再被引用时删除索引 (数据在压缩 pack 时回收)"""
+        row = conn.execute("SELECT pack, size, refs FROM blobs WHERE hash = ?", (image_hash,)).fetchone()
+        if not row:
+            return
+        pack, size, refs = row
+        if refs > 1:
+            conn.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (image_hash,))
+            return
+        conn.execute("DELETE FROM blobs WHERE hash = ?", (image_hash,))
+        self._add_live_bytes(conn, pack, -(size + self.HEADER_SIZE))
+
+    def add(self, email, image_data, latex, success, created_at=None, legacy_path=None):
+        """保存一条历史记录，返回记录ID；legacy_path 已导入过时返回 None"""
+        return self.add_many([{
+            'email': email, 'image_data': image_data, 'latex': latex, 'success': success,
+            'created_at': created_at, 'legacy_path': legacy_path
+        }])[0]
+
+    def add_many(self, entries):
+        """在一个写事务中保存多条历史记录，返回对应的记录ID列表"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = []
+            for entry in entries:
+                legacy_path = entry.get('legacy_path')
+                if legacy_path and conn.execute("SELECT 1 FROM history WHERE legacy_path = ?", (legacy_path,)).fetchone():
+                    ids.append(None)
+                    continue
+                image_hash = self._store_blob(conn, entry['image_data']) if entry.get('image_data') else None
+                created_at = entry.get('created_at')
+                cursor = conn.execute(
+                    "INSERT INTO history (email, created_at, success, latex, image_hash, legacy_path) VALUES (?, ?, ?, ?, ?, ?)",
+                    (entry['email'], created_at if created_at is not None else time.time(), 1 if entry['success'] else 0,
+                     entry['latex'], image_hash, legacy_path)
+                )
+                ids.append(cursor.lastrowid)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            self._count('errors')
+            raise
+        with self._lock:
+            self.stats['stores'] += sum(1 for entry_id in ids if entry_id is not None)
+        return ids
+
+    def get_image(self, image_hash):
+        """按哈希读取图片内容，不存在时返回 None"""
+        for attempt in range(2):
+            row = self._conn().execute("SELECT pack, offset, size FROM blobs WHERE hash = ?", (image_hash,)).fetchone()
+            if not row:
+                return None
+            try:
+                with open(self.pack_path(row[0]), 'rb') as f:
+                    f.seek(row[1])
+                    return f.read(row[2])
+            except FileNotFoundError:
+                # 读索引之后 pack 刚被压缩删除，图片已移动到新位置，重新查询
+                if attempt:
+                    raise
+
+    def expired_originals(self, cutoff, limit, include=None, exclude=None):
+        """查找 cutoff 之前、仍保存原图的记录，返回 [(id, image_hash)]；include/exclude 为限定或排除的邮箱列表"""
+        conditions, params = ["thumbnail = 0", "image_hash IS NOT NULL", "created_at < ?"], [cutoff]
+        if include is not None:
+            if not include:
+                return []
+            conditions.append(f"email IN ({','.join('?' * len(include))})")
+            params.extend(include)
+        if exclude:
+            conditions.append(f"email NOT IN ({','.join('?' * len(exclude))})")
+            params.extend(exclude)
+        return self._conn().execute(
+            f"SELECT id, image_hash FROM history WHERE {' AND '.join(conditions)} ORDER BY created_at LIMIT ?",
+            params + [limit]
+        ).fetchall()
+
+    def replace_image(self, entry_id, old_hash, data):
+        """把记录的原图替换为缩略图 data (None 表示保留原图)，并标记为已处理"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if data is None:
+                conn.execute("UPDATE history SET thumbnail = 1 WHERE id = ? AND image_hash = ?", (entry_id, old_hash))
+            else:
+                new_hash = self._store_blob(conn, data)
+                if conn.execute(
+                    "UPDATE history SET image_hash = ?, thumbnail = 1 WHERE id = ? AND image_hash = ?",
+                    (new_hash, entry_id, old_hash)
+                ).rowcount:
+                    self._release_blob(conn, old_hash)
+                else:
+                    self._release_blob(conn, new_hash)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def claim_tick(self, interval):
+        """多个工作进程中只有一个能领取本轮维护，领取成功返回 True"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM history_meta WHERE key = 'maintenance_next'").fetchone()
+            if row and float(row[0]) > now:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO history_meta (key, value) VALUES ('maintenance_next', ?)", (str(now + interval),)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def add_reclaimed(self, amount):
+        """累加回收的磁盘字节数 (所有进程共享)，返回累计值"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM history_meta WHERE key = 'reclaimed_bytes'").fetchone()
+            total = (int(row[0]) if row else 0) + amount
+            conn.execute("INSERT OR REPLACE INTO history_meta (key, value) VALUES ('reclaimed_bytes', ?)", (str(total),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return total
+
+    def compact(self, max_bytes, live_ratio):
+        """压缩一个有效数据比例低于 live_ratio 的旧 pack：最多移动 max_bytes 字节有效图片到当前 pack，
+        全部移走后删除该 pack，返回 (移动字节数, 删除的 pack 文件字节数)"""
+        conn = self._conn()
+        current = self._current_pack(conn)
+        live_bytes = dict(conn.execute("SELECT pack, live_bytes FROM pack_stats").fetchall())
+        candidates = []
+        for name in os.listdir(self.pack_folder):
+            match = re.fullmatch(r'pack-(\d+)\.pack', name)
+            if not match or int(match.group(1)) >= current:
+                continue
+            pack = int(match.group(1))
+            file_size = os.path.getsize(self.pack_path(pack))
+            live = live_bytes.get(pack, 0)
+            if file_size and live / file_size < live_ratio:
+                candidates.append((live / file_size, pack, file_size))
+        if not candidates:
+            return 0, 0
+        _, pack, file_size = min(candidates)
         
-        # 保存图片
+        # pack 文件只追加不修改，可以在事务外读取
+        # 按 (pack, offset) 索引逐行读取，只取本轮要移动的部分
+        moves, moved = [], 0
+        cursor = conn.execute("SELECT hash, offset, size FROM blobs WHERE pack = ? ORDER BY offset", (pack,))
         try:
-            # 处理 base64 数据 (可能包含 data:image/xxx;base64, 前缀)
-            if ',' in image_base64:
-                image_data = image_base64.split(',')[1]
+            with open(self.pack_path(pack), 'rb') as f:
+                for image_hash, offset, size in cursor:
+                    if moves and moved + size > max_bytes:
+                        break
+                    f.seek(offset)
+                    moves.append((image_hash, offset, f.read(size)))
+                    moved += size
+        finally:
+            cursor.close()
+        
+        appended = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for image_hash, offset, data in moves:
+                # 读取之后可能已被其他进程移动或删除
+                if not conn.execute(
+                    "SELECT 1 FROM blobs WHERE hash = ? AND pack = ? AND offset = ?", (image_hash, pack, offset)
+                ).fetchone():
+                    continue
+                new_pack, new_offset = self._append(conn, bytes.fromhex(image_hash), data)
+                conn.execute("UPDATE blobs SET pack = ?, offset = ? WHERE hash = ?", (new_pack, new_offset, image_hash))
+                self._add_live_bytes(conn, new_pack, len(data) + self.HEADER_SIZE)
+                self._add_live_bytes(conn, pack, -(len(data) + self.HEADER_SIZE))
+                appended += len(data) + self.HEADER_SIZE
+            remaining = conn.execute("SELECT 1 FROM blobs WHERE pack = ? LIMIT 1", (pack,)).fetchone()
+            if not remaining:
+                conn.execute("DELETE FROM pack_stats WHERE pack = ?", (pack,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        
+        if remaining:
+            return appended, 0
+        os.remove(self.pack_path(pack))
+        return appended, file_size
+
+    ENTRY_COLUMNS = "h.id, h.email, h.created_at, h.success, h.latex, h.image_hash"
+
+    @staticmethod
+    def _entry(row):
+        return {'id': row[0], 'email': row[1], 'created_at': row[2], 'success': bool(row[3]), 'latex': row[4], 'image_hash': row[5]}
+
+    def query(self, email=None, before=None, limit=50, since=None, until=None, success=None, search=None):
+        """按ID倒序分页查询历史记录 (keyset 分页)，before 为上一页最后一条的ID；email 为 None 时查询所有用户"""
+        conn = self._conn()
+        conditions, params = [], []
+        source, key = "history h", "h.id"
+        if search:
+            if self.fts_enabled and len(search) >= 3:
+                # 由全文索引按 rowid 倒序驱动查询，无需对全部匹配结果排序；整体作为短语匹配，避免用户输入被解析为 FTS 查询语法
+                source, key = "history_fts CROSS JOIN history h ON h.id = history_fts.rowid", "history_fts.rowid"
+                conditions.append("history_fts MATCH ?")
+                params.append('"' + search.replace('"', '""') + '"')
             else:
-                image_data = image_base64
-            
-            image_bytes = base64.b64decode(image_data)
-            image_path = os.path.join(history_folder, "image.png")
-            with open(image_path, 'wb') as f:
-                f.write(image_bytes)
+                # trigram 索引无法匹配少于 3 个字符的查询；不支持全文索引时也走这里
+                # trigram 默认不区分大小写，这里同样忽略大小写，保证结果与 SQLite 版本无关
+                conditions.append("instr(lower(h.latex), lower(?)) > 0")
+                params.append(search)
+        if email is not None:
+            conditions.append("h.email = ?")
+            params.append(email)
+        if before is not None:
+            conditions.append(f"{key} < ?")
+            params.append(before)
+        if since is not None:
+            conditions.append("h.created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("h.created_at < ?")
+            params.append(until)
+        if success is not None:
+            conditions.append("h.success = ?")
+            params.append(1 if success else 0)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = conn.execute(
+            f"SELECT {self.ENTRY_COLUMNS} FROM {source} {where} ORDER BY {key} DESC LIMIT ?",
+            params + [limit]
+        ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def get_entry(self, entry_id):
+        """按ID读取一条历史记录，不存在时返回 None"""
+        row = self._conn().execute(
+            f"SELECT {self.ENTRY_COLUMNS} FROM history h WHERE h.id = ?", (entry_id,)
+        ).fetchone()
+        return self._entry(row) if row else None
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+history_store = HistoryStore(config.HISTORY_DB, config.HISTORY_PACK_FOLDER, config.HISTORY_PACK_MAX_BYTES)
+
+class HistoryWriter(BackgroundWriter):
+    """历史记录后台写入：一批记录在一个事务中写入
+
+    队列满时请求线程最多等待 enqueue_timeout 秒 (反压)，仍然满则丢弃该记录并计数。
+    """
+
+    thread_name = 'history-writer'
+    close_timeout = 10
+
+    def __init__(self, store, batch_size, flush_interval, queue_size, enqueue_timeout):
+        super().__init__(batch_size, flush_interval, queue_size, enqueue_timeout)
+        self.store = store
+
+    def write(self, entry):
+        if not super().write(entry):
+            logger.error(f"History queue full, dropped history for {entry['email']}")
+
+    def _flush(self, batch):
+        try:
+            self.store.add_many(batch)
+            self._count('written', len(batch))
         except Exception as e:
-            logger.error(f"Failed to save image for user {email}: {e}")
-        
-        # 保存结果
-        result_path = os.path.join(history_folder, "result.txt")
-        with open(result_path, 'w', encoding='utf-8') as f:
-            f.write(latex_result if latex_result else "无结果")
-        
-        # 保存元数据
-        metadata = {
-            "email": email,
-            "timestamp": datetime.now().isoformat(),
-            "success": success,
-            "latex_length": len(latex_result) if latex_result else 0
+            logger.error(f"Failed to save history batch, retrying one by one: {e}")
+            # 整批失败时逐条重试，避免一条坏记录拖累同批的其他记录
+            for entry in batch:
+                try:
+                    self.store.add_many([entry])
+                    self._count('written')
+                except Exception as e:
+                    self._count('errors')
+                    logger.error(f"Failed to save user history for {entry['email']}: {e}")
+
+history_writer = HistoryWriter(
+    history_store,
+    batch_size=config.HISTORY_WRITE_BATCH_SIZE,
+    flush_interval=config.HISTORY_WRITE_FLUSH_INTERVAL,
+    queue_size=config.HISTORY_WRITE_QUEUE_SIZE,
+    enqueue_timeout=config.HISTORY_ENQUEUE_TIMEOUT
+)
+atexit.register(history_writer.close)
+
+class HistoryMaintenance:
+    """历史记录保留策略后台任务：原图超过角色保留天数后替换为缩略图 (结果永久保留)，并压缩有效数据比例低的 pack 文件
+
+    每 interval 秒一轮，所有工作进程中只有一个执行；每轮最多处理 batch 条记录、移动 compact_bytes 字节，避免长时间占用磁盘。
+    """
+
+    def __init__(self, store, interval, batch, compact_bytes, live_ratio):
+        self.store = store
+        self.interval = interval
+        self.batch = batch
+        self.compact_bytes = compact_bytes
+        self.live_ratio = live_ratio
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'ticks': 0, 'thumbnails': 0, 'kept_originals': 0, 'compacted_packs': 0,
+            'reclaimed_bytes': 0, 'total_reclaimed_bytes': 0, 'errors': 0, 'last_tick_ms': 0
         }
-        metadata_path = os.path.join(history_folder, "metadata.json")
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+    def start(self):
+        # 维护线程按进程启动（gunicorn fork 之后）
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="history-maintenance", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.store.claim_tick(self.interval):
+                    self.tick()
+            except Exception as e:
+                with self._lock:
+                    self.stats['errors'] += 1
+                logger.error(f"History maintenance failed: {e}")
+
+    def _policies(self):
+        """返回 [(截止时间, 限定邮箱, 排除邮箱)]；管理员列表读取失败时返回 None，本轮跳过"""
+        now = time.time()
+        admins = []
+        conn = get_db_connection()
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT email FROM \"user\" WHERE role = 'admin'")
+            admins = [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            logger.error(f"History maintenance: failed to load admin list: {e}")
+            return None
+        finally:
+            release_db_connection(conn)
+        
+        policies = []
+        if config.HISTORY_ADMIN_ORIGINAL_DAYS > 0:
+            policies.append((now - config.HISTORY_ADMIN_ORIGINAL_DAYS * 86400, admins, None))
+        if config.HISTORY_ORIGINAL_DAYS > 0:
+            policies.append((now - config.HISTORY_ORIGINAL_DAYS * 86400, None, admins))
+        return policies
+
+    def make_thumbnail(self, data):
+        """缩小原图，结果不比原图小时返回 None (保留原图)"""
+        img = Image.open(io.BytesIO(data))
+        img.thumbnail((config.HISTORY_THUMBNAIL_MAX_SIZE, config.HISTORY_THUMBNAIL_MAX_SIZE), Image.Resampling.LANCZOS)
+        if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+            # 透明背景的截图直接转 RGB 会变成黑底，先合成到白色背景上
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, 'white')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        thumbnail, _ = encode_smallest(img, {'image_quality': config.HISTORY_THUMBNAIL_QUALITY})
+        return thumbnail if len(thumbnail) < len(data) else None
+
+    def tick(self):
+        """执行一轮维护，返回本轮回收的字节数"""
+        started = time.monotonic()
+        thumbnails = kept = 0
+        policies = self._policies() or []
+        remaining = self.batch
+        for cutoff, include, exclude in policies:
+            for entry_id, image_hash in self.store.expired_originals(cutoff, remaining, include, exclude):
+                data = self.store.get_image(image_hash)
+                thumbnail = None
+                if data is not None:
+                    try:
+                        thumbnail = self.make_thumbnail(data)
+                    except Exception as e:
+                        logger.warning(f"History maintenance: cannot downsample entry #{entry_id}: {e}")
+                self.store.replace_image(entry_id, image_hash, thumbnail)
+                if thumbnail is None:
+                    kept += 1
+                else:
+                    thumbnails += 1
+                remaining -= 1
+            if remaining <= 0:
+                break
         
-        logger.info(f"Saved user history for {email} at {history_folder}")
+        appended, freed = self.store.compact(self.compact_bytes, self.live_ratio)
+        reclaimed = freed - appended
+        total = self.store.add_reclaimed(reclaimed) if reclaimed else None
         
+        with self._lock:
+            self.stats['ticks'] += 1
+            self.stats['thumbnails'] += thumbnails
+            self.stats['kept_originals'] += kept
+            self.stats['compacted_packs'] += 1 if freed else 0
+            self.stats['reclaimed_bytes'] += reclaimed
+            if total is not None:
+                self.stats['total_reclaimed_bytes'] = total
+            self.stats['last_tick_ms'] = round((time.monotonic() - started) * 1000, 1)
+        if thumbnails or freed:
+            logger.info(f"History maintenance: {thumbnails} thumbnails, reclaimed {reclaimed} bytes")
+        return reclaimed
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+history_maintenance = HistoryMaintenance(
+    history_store,
+    interval=config.HISTORY_MAINTENANCE_INTERVAL,
+    batch=config.HISTORY_MAINTENANCE_BATCH,
+    compact_bytes=config.HISTORY_COMPACT_BYTES,
+    live_ratio=config.HISTORY_COMPACT_LIVE_RATIO
+)
+
+def save_user_history(email, image, latex_result, success):
+    """
+    保存用户历史记录：上传的图片和AI返回的结果 (后台批量写入 history_store)
+    """
+    # 队列中只保存图片字节，不持有解码后的位图（积压时位图会占用大量内存）
+    try:
+        image_data = as_uploaded_image(image).data
     except Exception as e:
-        logger.error(f"Failed to save user history for {email}: {e}")
+        image_data = None
+        logger.error(f"Failed to save image for user {email}: {e}")
+    history_writer.write({
+        'email': email,
+        'image_data': image_data,
+        'latex': latex_result if latex_result else "无结果",
+        'success': success,
+        'created_at': time.time()
+    })
 
 def mask_email(email):
     if not email or '@' not in email:
@@ -259,151 +1359,1187 @@ def mask_email(email):
     except:
         return email
 
-def get_display_logs():
-    if not os.path.exists(USAGE_LOG_FILE):
-        return []
-    
-    logs = []
-    try:
-        with open(USAGE_LOG_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+class UsageLogAggregator:
+    """使用日志增量聚合：只读取上次读到的位置之后新追加的内容，内存中维护按 30 分钟合并的最近若干组
+
+    日志文件被轮转（inode 变化）或截断时从新文件开头继续读，已聚合的分组保留，不重新处理旧日志。
+    首次加载时只读取文件末尾 backfill_bytes 字节。
+    """
+
+    def __init__(self, path, max_groups, backfill_bytes, merge_window=1800):
+        self.path = path
+        self.merge_window = merge_window
+        self.backfill_bytes = backfill_bytes
+        self.groups = deque(maxlen=max_groups)
+        self._file_id = None
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _add(self, line):
+        parts = line.strip().split('|')
+        if len(parts) < 3:
+            return
+        try:
+            dt = datetime.fromisoformat(parts[0])
+        except ValueError:
+            return
+        email, status = parts[1], parts[2]
         
-        # Parse lines
-        parsed_logs = []
-        for line in lines:
-            try:
-                parts = line.strip().split('|')
-                if len(parts) >= 3:
-                    timestamp_str = parts[0]
-                    email = parts[1]
-                    status = parts[2]
-                    dt = datetime.fromisoformat(timestamp_str)
-                    parsed_logs.append({
-                        'dt': dt,
-                        'email': email,
-                        'status': status,
-                        'original_line': line
-                    })
-            except Exception as e:
-                continue
+        # 同一用户、同一状态且与上一条相隔不超过 30 分钟时合并到同一组
+        last = self.groups[-1] if self.groups else None
+        if (last and last['email'] == email and last['status'] == status
+                and abs((dt - last['last_dt']).total_seconds()) <= self.merge_window):
+            last['count'] += 1
+            last['last_dt'] = dt
+            last['latest_dt'] = max(last['latest_dt'], dt)
+        else:
+            self.groups.append({'email': email, 'status': status, 'count': 1, 'last_dt': dt, 'latest_dt': dt})
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
         
-        # Sort by time descending
-        parsed_logs.sort(key=lambda x: x['dt'], reverse=True)
+        skip_partial = False
+        file_id = (st.st_dev, st.st_ino)
+        if file_id != self._file_id:
+            # 首次加载只读末尾；轮转后的新文件从头读
+            self._offset = max(0, st.st_size - self.backfill_bytes) if self._file_id is None else 0
+            skip_partial = self._offset > 0
+            self._file_id = file_id
+        elif st.st_size < self._offset:
+            # 原地截断 (copytruncate)
+            self._offset = 0
         
-        # Merge logs
-        merged_logs = []
-        if not parsed_logs:
-            return []
-            
-        current_group = [parsed_logs[0]]
+        if st.st_size <= self._offset:
+            return
         
-        for i in range(1, len(parsed_logs)):
-            log = parsed_logs[i]
-            prev = current_group[-1]
-            
-            # Check if same user and status within 30 minutes
-            time_diff = abs((prev['dt'] - log['dt']).total_seconds())
-            if log['email'] == prev['email'] and log['status'] == prev['status'] and time_diff <= 1800:
-                current_group.append(log)
-            else:
-                # Process current group -> take the latest one (which is the first in group due to sort)
-                latest_log = current_group[0]
-                count = len(current_group)
-                display_time = latest_log['dt'].strftime("%Y-%m-%d %H:%M:%S")
-                masked = mask_email(latest_log['email'])
-                
-                msg = f"用户 {masked} 在 {display_time} 使用转换功能 {'成功' if latest_log['status'] == 'Success' else '失败'}"
-                if count > 1:
-                    msg += f" (含近30分钟内 {count} 次记录)"
-                
-                merged_logs.append(msg)
-                current_group = [log]
-        
-        # Process last group
-        if current_group:
-            latest_log = current_group[0]
-            count = len(current_group)
-            display_time = latest_log['dt'].strftime("%Y-%m-%d %H:%M:%S")
-            masked = mask_email(latest_log['email'])
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read(st.st_size - self._offset)
+        
+        start = data.find(b'\n') + 1 if skip_partial else 0
+        # 最后一行可能还没写完，留到下次读取
+        end = data.rfind(b'\n') + 1
+        if end <= start:
+            return
+        self._offset += end
+        for line in data[start:end].decode('utf-8', errors='replace').splitlines():
+            self._add(line)
+
+    def latest(self, limit=None):
+        """最新的若干组，按时间倒序"""
+        with self._lock:
+            self._refresh()
+            groups = list(self.groups)
+        groups.reverse()
+        return groups[:limit] if limit else groups
+
+usage_log_aggregator = UsageLogAggregator(
+    USAGE_LOG_FILE,
+    max_groups=config.USAGE_LOG_DISPLAY_LIMIT,
+    backfill_bytes=config.USAGE_LOG_BACKFILL_BYTES
+)
+
+def get_display_logs():
+    try:
+        merged_logs = []
+        for group in usage_log_aggregator.latest():
+            display_time = group['latest_dt'].strftime("%Y-%m-%d %H:%M:%S")
+            masked = mask_email(group['email'])
             
-            msg = f"用户 {masked} 在 {display_time} 使用转换功能 {'成功' if latest_log['status'] == 'Success' else '失败'}"
-            if count > 1:
-                msg += f" (含近30分钟内 {count} 次记录)"
+            msg = f"用户 {masked} 在 {display_time} 使用转换功能 {'成功' if group['status'] == 'Success' else '失败'}"
+            if group['count'] > 1:
+                msg += f" (含近30分钟内 {group['count']} 次记录)"
             
             merged_logs.append(msg)
-            
+        
         return merged_logs
         
     except Exception as e:
         logger.error(f"Error reading logs: {e}")
         return []
 
+# --- Result Cache Functions ---
+
+_sqlite_local = threading.local()
+
+def get_sqlite_connection(path):
+    """获取当前线程的 SQLite 连接（WAL 模式，可被多个工作进程共享）"""
+    if getattr(_sqlite_local, 'pid', None) != os.getpid():
+        _sqlite_local.pid = os.getpid()
+        _sqlite_local.conns = {}
+    conn = _sqlite_local.conns.get(path)
+    if conn is None:
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=config.SQLITE_BUSY_TIMEOUT, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _sqlite_local.conns[path] = conn
+    return conn
+
+class ResultCache:
+    """LaTeX 结果缓存：进程内 LRU + SQLite 持久层（按总字节数淘汰最久未访问的条目）"""
+
+    def __init__(self, db_path, memory_size, max_bytes):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.memory = TTLCache(memory_size, float('inf'))
+        self._schema_ready = False
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'errors': 0}
+
+    def _conn(self):
+        conn = get_sqlite_connection(self.db_path)
+        if not self._schema_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS result_cache (
+                    key TEXT PRIMARY KEY,
+                    latex TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_access ON result_cache (last_access)")
+            # 总字节数由触发器维护，写入时不必 SUM 全表
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'result_cache_meta'").fetchone():
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("CREATE TABLE IF NOT EXISTS result_cache_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+                    conn.execute(
+                        "INSERT OR REPLACE INTO result_cache_meta (name, value) "
+                        "SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM result_cache"
+                    )
+                    conn.execute("""
+                        CREATE TRIGGER IF NOT EXISTS result_cache_insert AFTER INSERT ON result_cache BEGIN
+                            UPDATE result_cache_meta SET value = value + new.size WHERE name = 'total_bytes';
+                        END
+                    """)
+                    conn.execute("""
+                        CREATE TRIGGER IF NOT EXISTS result_cache_update AFTER UPDATE OF size ON result_cache BEGIN
+                            UPDATE result_cache_meta SET value = value + new.size - old.size WHERE name = 'total_bytes';
+                        END
+                    """)
+                    conn.execute("""
+                        CREATE TRIGGER IF NOT EXISTS result_cache_delete AFTER DELETE ON result_cache BEGIN
+                            UPDATE result_cache_meta SET value = value - old.size WHERE name = 'total_bytes';
+                        END
+                    """)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            self._schema_ready = True
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key):
+        latex = self.memory.get(key)
+        if latex is not None:
+            self._count('memory_hits')
+            return latex
+        try:
+            conn = self._conn()
+            row = conn.execute("SELECT latex FROM result_cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("UPDATE result_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.memory.set(key, row[0])
+                self._count('disk_hits')
+                return row[0]
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Result cache read error: {e}")
+        self._count('misses')
+        return None
+
+    def set(self, key, latex):
+        self.memory.set(key, latex)
+        try:
+            conn = self._conn()
+            now = time.time()
+            size = len(key) + len(latex.encode('utf-8'))
+            # 不用 INSERT OR REPLACE：REPLACE 删除旧行时不触发删除触发器，总字节数会偏大
+            conn.execute(
+                "INSERT INTO result_cache (key, latex, size, created_at, last_access) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET latex = excluded.latex, size = excluded.size, last_access = excluded.last_access",
+                (key, latex, size, now, now)
+            )
+            self._count('stores')
+            total = conn.execute("SELECT value FROM result_cache_meta WHERE name = 'total_bytes'").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(conn, total)
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Result cache write error: {e}")
+
+    def _evict(self, conn, total):
+        """淘汰最久未访问的条目，直到总字节数降到上限的 90%，避免之后每次写入都触发淘汰"""
+        target = self.max_bytes * 0.9
+        while total > target:
+            rows = conn.execute("SELECT key, size FROM result_cache ORDER BY last_access LIMIT 500").fetchall()
+            if not rows:
+                break
+            keys = []
+            for key, size in rows:
+                keys.append(key)
+                total -= size
+                if total <= target:
+                    break
+            conn.execute(f"DELETE FROM result_cache WHERE key IN ({','.join('?' * len(keys))})", keys)
+            for key in keys:
+                self.memory.invalidate(key)
+            with self._lock:
+                self.stats['evictions'] += len(keys)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        hits = stats['memory_hits'] + stats['disk_hits']
+        lookups = hits + stats['misses']
+        stats['hit_rate'] = round(hits / lookups, 4) if lookups else 0.0
+        stats['memory_entries'] = self.memory.get_stats()['size']
+        return stats
+
+result_cache = ResultCache(config.RESULT_CACHE_DB, config.RESULT_CACHE_MEMORY_SIZE, config.RESULT_CACHE_MAX_BYTES)
+
+class SimilarImageIndex:
+    """感知哈希近似查找索引
+
+    采用多段索引 (multi-index hashing)：把哈希均分为 max_distance+1 段，按鸽巢原理，
+    汉明距离不超过 max_distance 的两个哈希至少有一段完全相同。查询时只按段精确匹配
+    取出少量候选再计算距离，不需要线性扫描全部记录。
+    """
+
+    def __init__(self, db_path, max_distance, hash_bits, max_aspect_diff, candidate_limit=200):
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.hash_bits = hash_bits
+        self.max_aspect_diff = max_aspect_diff
+        self.candidate_limit = candidate_limit
+        self.band_count = max_distance + 1
+        self._schema_ready = False
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'candidates': 0, 'errors': 0}
+
+    def _conn(self):
+        conn = get_sqlite_connection(self.db_path)
+        if not self._schema_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS phash_entries (
+                    id INTEGER PRIMARY KEY,
+                    namespace TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    aspect REAL NOT NULL,
+                    latex TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    UNIQUE (namespace, hash)
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS phash_bands (band_key TEXT NOT NULL, entry_id INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_phash_bands_key ON phash_bands (band_key)")
+            conn.execute("CREATE TABLE IF NOT EXISTS phash_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            row = conn.execute("SELECT value FROM phash_meta WHERE key = 'band_count'").fetchone()
+            if row is None or int(row[0]) != self.band_count:
+                self._rebuild_bands(conn)
+            self._schema_ready = True
+        return conn
+
+    def _rebuild_bands(self, conn):
+        """相似度阈值变化后分段数随之变化，需要重建分段索引"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM phash_bands")
+            for entry_id, namespace, hash_hex in conn.execute("SELECT id, namespace, hash FROM phash_entries").fetchall():
+                conn.executemany(
+                    "INSERT INTO phash_bands (band_key, entry_id) VALUES (?, ?)",
+                    [(key, entry_id) for key in self._band_keys(namespace, int(hash_hex, 16))]
+                )
+            conn.execute("INSERT OR REPLACE INTO phash_meta (key, value) VALUES ('band_count', ?)", (str(self.band_count),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _band_keys(self, namespace, value):
+        keys = []
+        for i in range(self.band_count):
+            start = i * self.hash_bits // self.band_count
+            end = (i + 1) * self.hash_bits // self.band_count
+            band = (value >> start) & ((1 << (end - start)) - 1)
+            keys.append(f"{namespace}:{i}:{band:x}")
+        return keys
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def lookup(self, namespace, value, aspect):
+        """查找最相近的历史结果，返回 (latex, 汉明距离)，没有足够相近的记录时返回 None"""
+        try:
+            conn = self._conn()
+            seen = set()
+            best = None
+            for key in self._band_keys(namespace, value):
+                rows = conn.execute(
+                    "SELECT e.id, e.hash, e.aspect, e.latex FROM phash_bands b "
+                    "JOIN phash_entries e ON e.id = b.entry_id WHERE b.band_key = ? LIMIT ?",
+                    (key, self.candidate_limit)
+                ).fetchall()
+                for entry_id, hash_hex, entry_aspect, latex in rows:
+                    if entry_id in seen:
+                        continue
+                    seen.add(entry_id)
+                    if abs(entry_aspect - aspect) > self.max_aspect_diff * max(entry_aspect, aspect):
+                        continue
+                    distance = bin(int(hash_hex, 16) ^ value).count('1')
+                    if distance <= self.max_distance and (best is None or distance < best[1]):
+                        best = (latex, distance)
+                if best is not None and best[1] == 0:
+                    break
+            self._count('candidates', len(seen))
+            self._count('hits' if best else 'misses')
+            return best
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Similar image lookup error: {e}")
+            return None
+
+    def add(self, namespace, value, aspect, latex):
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO phash_entries (namespace, hash, aspect, latex, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (namespace, f"{value:x}", aspect, latex, time.time())
+                )
+                if cur.rowcount:
+                    conn.executemany(
+                        "INSERT INTO phash_bands (band_key, entry_id) VALUES (?, ?)",
+                        [(key, cur.lastrowid) for key in self._band_keys(namespace, value)]
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._count('stores')
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Similar image index write error: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['max_distance'] = self.max_distance
+        return stats
+
+similar_index = SimilarImageIndex(
+    config.SIMILAR_CACHE_DB,
+    max_distance=config.SIMILAR_CACHE_MAX_DISTANCE,
+    hash_bits=config.SIMILAR_CACHE_HASH_SIZE ** 2,
+    max_aspect_diff=config.SIMILAR_CACHE_MAX_ASPECT_DIFF
+)
+
+def compute_image_dhash(img, hash_size):
+    """计算裁掉白边后的差值哈希 (dHash)，返回 (哈希整数, 内容区域宽高比)"""
+    gray = img.convert('L')
+    # 裁掉近白色边距，使截图范围不同的同一公式得到相近的哈希
+    bbox = ImageOps.invert(gray).point(lambda p: 255 if p > 32 else 0).getbbox()
+    if bbox:
+        gray = gray.crop(bbox)
+    aspect = gray.width / gray.height if gray.height else 1.0
+    small = gray.resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    # 相邻像素差小于 8 个灰度级视为相等，避免 JPEG 噪声在空白区域随机翻转比特
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (1 if pixels[offset + col] > pixels[offset + col + 1] + 8 else 0)
+    return value, aspect
+
+def get_result_namespace(config):
+    """模型、提示词和温度共同决定结果，不同参数的结果互不复用；多个上游接口共享同一组模型的结果"""
+    digest = hashlib.sha256()
+    models = sorted({provider['model'] for provider in provider_router.providers})
+    digest.update(','.join(models).encode('utf-8'))
+    digest.update(b'\0' + get_prompt_text().encode('utf-8'))
+    digest.update(b'\0' + repr(config['temperature']).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def make_result_cache_key(optimized_image, config):
+    """根据优化后的图片内容和模型参数生成缓存键"""
+    digest = hashlib.sha256()
+    digest.update(optimized_image.encode('utf-8'))
+    digest.update(b'\0' + get_result_namespace(config).encode('utf-8'))
+    return digest.hexdigest()
+
+class SingleFlight:
+    """跨进程请求合并：相同键的并发转换只有一个领头请求调用模型，其余请求等待并共享其结果
+
+    进行中的请求登记在 SQLite 中，各工作进程都能看到；领头进程崩溃或超过租期后，
+    等待者中的一个会接替成为新的领头请求。
+    """
+
+    def __init__(self, db_path, lease, result_ttl=30, poll_interval=0.1):
+        self.db_path = db_path
+        self.lease = lease
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._events = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self.stats = {'leaders': 0, 'followers': 0, 'shared': 0, 'takeovers': 0, 'timeouts': 0, 'errors': 0}
+
+    def _conn(self):
+        conn = get_sqlite_connection(self.db_path)
+        if not self._schema_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS inflight (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    finished_at REAL,
+                    result TEXT
+                )
+            """)
+            self._schema_ready = True
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _local_events(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._events = {}
+        return self._events
+
+    def _try_acquire(self, conn, key, owner, now):
+        # 没有记录、上一次已完成或领头请求超过租期时成为新的领头请求
+        cursor = conn.execute("""
+            INSERT INTO inflight (key, owner, started_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                owner = excluded.owner, started_at = excluded.started_at, finished_at = NULL, result = NULL
+            WHERE inflight.finished_at IS NOT NULL OR inflight.started_at < ?
+        """, (key, owner, now, now - self.lease))
+        return cursor.rowcount == 1
+
+    def begin(self, key):
+        """返回 (owner, shared)：成为领头请求时 owner 非空；等到其他请求的结果时 shared 为结果字典；
+        两者皆为 None 表示等待超时或出错，调用方应自行请求"""
+        owner = uuid.uuid4().hex
+        try:
+            conn = self._conn()
+            now = time.time()
+            conn.execute("DELETE FROM inflight WHERE finished_at < ?", (now - self.result_ttl,))
+            if self._try_acquire(conn, key, owner, now):
+                with self._lock:
+                    self._local_events()[key] = threading.Event()
+                self._count('leaders')
+                return owner, None
+            
+            self._count('followers')
+            row = conn.execute("SELECT owner FROM inflight WHERE key = ?", (key,)).fetchone()
+            current = row[0] if row else None
+            deadline = time.monotonic() + self.lease
+            while time.monotonic() < deadline:
+                row = conn.execute("SELECT owner, finished_at, result FROM inflight WHERE key = ?", (key,)).fetchone()
+                if row and row[0] == current and row[1] is not None:
+                    self._count('shared')
+                    return None, json.loads(row[2])
+                if not row or row[0] != current:
+                    # 领头请求放弃（客户端断开等），尝试接替
+                    if self._try_acquire(conn, key, owner, time.time()):
+                        with self._lock:
+                            self._local_events()[key] = threading.Event()
+                        self._count('takeovers')
+                        return owner, None
+                    row = conn.execute("SELECT owner FROM inflight WHERE key = ?", (key,)).fetchone()
+                    current = row[0] if row else None
+                    continue
+                with self._lock:
+                    event = self._local_events().get(key)
+                # 同一进程内的领头请求完成时立即唤醒，其他进程按间隔轮询
+                if event:
+                    event.wait(self.poll_interval)
+                else:
+                    time.sleep(self.poll_interval)
+            self._count('timeouts')
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Single-flight error: {e}")
+        return None, None
+
+    def finish(self, key, owner, result):
+        """领头请求结束：result 为 None 时放弃本次登记，让等待者接替"""
+        try:
+            conn = self._conn()
+            if result is None:
+                conn.execute("DELETE FROM inflight WHERE key = ? AND owner = ? AND finished_at IS NULL", (key, owner))
+            else:
+                conn.execute(
+                    "UPDATE inflight SET finished_at = ?, result = ? WHERE key = ? AND owner = ?",
+                    (time.time(), json.dumps(result, ensure_ascii=False), key, owner)
+                )
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Single-flight error: {e}")
+        finally:
+            with self._lock:
+                event = self._local_events().pop(key, None)
+            if event:
+                event.set()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+single_flight = SingleFlight(config.COALESCE_DB, lease=config.COALESCE_LEASE)
+
+class TokenBucketLimiter:
+    """令牌桶限流，桶状态保存在 SQLite 中，所有工作进程共享同一份配额
+
+    每个桶的容量为一分钟的配额，按 rate/60 每秒匀速补充。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = get_sqlite_connection(self.db_path)
+        if not self._schema_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._schema_ready = True
+        return conn
+
+    def acquire(self, limits):
+        """limits 为 [(桶名, 每分钟配额, 本次消耗)]；所有桶都足够时一并扣除并返回 0，
+        否则不扣除，返回还需等待的秒数
+
+        单次消耗超过桶容量时，要等桶满才放行，并按实际消耗扣除（桶变为负数），之后的请求等待补足欠额。
+        """
+        limits = [(key, rate, cost) for key, rate, cost in limits if rate > 0]
+        if not limits:
+            return 0
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels = []
+            wait_seconds = 0
+            for key, rate, cost in limits:
+                row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = rate if row is None else min(rate, row[0] + (now - row[1]) * rate / 60)
+                need = min(cost, rate)
+                if tokens < need:
+                    wait_seconds = max(wait_seconds, (need - tokens) * 60 / rate)
+                levels.append((key, tokens, cost))
+            if not wait_seconds:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                    [(key, tokens - cost, now) for key, tokens, cost in levels]
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait_seconds
+
+upstream_limiter = TokenBucketLimiter(config.RATE_LIMIT_DB)
+
+class RateCounter:
+    """事件计数器：累计次数和最近一分钟内的次数"""
+
+    def __init__(self, names, window=60):
+        self.window = window
+        self._lock = threading.Lock()
+        self.totals = {name: 0 for name in names}
+        self._recent = {name: deque() for name in names}
+
+    def add(self, name, amount=1):
+        now = time.monotonic()
+        with self._lock:
+            self.totals[name] += amount
+            self._recent[name].append((now, amount))
+            self._prune(self._recent[name], now)
+
+    def _prune(self, events, now):
+        while events and now - events[0][0] > self.window:
+            events.popleft()
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = {}
+            for name, events in self._recent.items():
+                self._prune(events, now)
+                stats[name] = {'total': self.totals[name], 'last_minute': sum(amount for _, amount in events)}
+            return stats
+
+user_limiter = TokenBucketLimiter(config.RATE_LIMIT_DB)
+user_rate_stats = RateCounter(['rejected'])
+
+upstream_stats = RateCounter(['retries', 'rate_limited', 'server_errors', 'provider_errors', 'throttled', 'throttle_rejected'])
+
+# --- Upstream Providers ---
+
+def load_providers():
+    """读取上游接口列表；未配置 OPENAI_PROVIDERS 时只有 OPENAI_API_BASE 一个接口"""
+    providers = []
+    for i, item in enumerate(config.OPENAI_PROVIDERS):
+        provider = {
+            'name': item.get('name') or f"provider{i + 1}",
+            'api_base': item.get('api_base') or config.OPENAI_API_BASE,
+            'api_key': item.get('api_key') or config.OPENAI_API_KEY,
+            'model': item.get('model') or config.OPENAI_MODEL,
+            'weight': float(item.get('weight', 1)),
+            'rpm': int(item.get('rpm', config.API_RPM_LIMIT)),
+            'tpm': int(item.get('tpm', config.API_TPM_LIMIT))
+        }
+        # 没有密钥或权重为 0 的接口不参与路由
+        if provider['api_key'] and provider['weight'] > 0:
+            providers.append(provider)
+    return providers
+
+class ProviderRouter:
+    """上游接口路由：按 权重/近期 p50 延迟 加权随机选择接口，连续失败的接口熔断一段时间
+
+    熔断后超过 reset_timeout 秒进入半开状态，只放行一个探测请求，成功则恢复，失败则继续熔断。
+    """
+
+    def __init__(self, providers, window, failure_threshold, reset_timeout, min_samples=5):
+        self.providers = providers
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._state = {
+            provider['name']: {
+                'latencies': deque(maxlen=window),
+                'requests': 0,
+                'failures': 0,
+                'hedges': 0,
+                'hedge_wins': 0,
+                'consecutive_failures': 0,
+                'circuit': 'closed',
+                'opened_at': 0.0,
+                'probing': False
+            }
+            for provider in providers
+        }
+
+    @staticmethod
+    def _percentile(latencies, q):
+        if not latencies:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def _available(self, state, now):
+        if state['circuit'] == 'open' and now - state['opened_at'] >= self.reset_timeout:
+            state['circuit'] = 'half_open'
+            state['probing'] = False
+        return state['circuit'] == 'closed' or (state['circuit'] == 'half_open' and not state['probing'])
+
+    def choose(self, exclude=()):
+        """选择一个可用接口，全部熔断时返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                provider for provider in self.providers
+                if provider['name'] not in exclude and self._available(self._state[provider['name']], now)
+            ]
+            if not candidates:
+                return None
+            p50s = [self._percentile(self._state[provider['name']]['latencies'], 0.5) for provider in candidates]
+            known = sorted(p50 for p50 in p50s if p50 is not None)
+            # 还没有延迟样本的接口按已知接口的中位数对待
+            default = known[len(known) // 2] if known else 1.0
+            weights = [
+                provider['weight'] / max(p50 if p50 is not None else default, 0.05)
+                for provider, p50 in zip(candidates, p50s)
+            ]
+            provider = random.choices(candidates, weights=weights)[0]
+            state = self._state[provider['name']]
+            if state['circuit'] == 'half_open':
+                state['probing'] = True
+            return provider
+
+    def record(self, provider, success, latency):
+        """记录一次请求结果，更新延迟样本和熔断状态
+
+        success 为 None 表示请求本身有问题 (如 400/413)，不能说明接口好坏：不计入延迟样本和熔断，只释放半开探测名额。
+        """
+        with self._lock:
+            state = self._state[provider['name']]
+            state['requests'] += 1
+            if success is None:
+                state['probing'] = False
+                return
+            if success:
+                state['latencies'].append(latency)
+                state['consecutive_failures'] = 0
+                if state['circuit'] != 'closed':
+                    logger.info(f"上游接口 {provider['name']} 已恢复")
+                state['circuit'] = 'closed'
+                state['probing'] = False
+                return
+            state['failures'] += 1
+            state['consecutive_failures'] += 1
+            if state['circuit'] == 'half_open' or (
+                state['circuit'] == 'closed' and state['consecutive_failures'] >= self.failure_threshold
+            ):
+                logger.warning(f"上游接口 {provider['name']} 连续失败 {state['consecutive_failures']} 次，熔断 {self.reset_timeout:.0f} 秒")
+                state['circuit'] = 'open'
+                state['opened_at'] = time.monotonic()
+                state['probing'] = False
+
+    def release(self, provider):
+        """请求未完成就放弃时调用，不影响统计"""
+        with self._lock:
+            self._state[provider['name']]['probing'] = False
+
+    def hedge_delay(self, provider):
+        """接口的 p95 延迟，样本不足时返回 None（不发对冲请求）"""
+        with self._lock:
+            latencies = self._state[provider['name']]['latencies']
+            if len(latencies) < self.min_samples:
+                return None
+            return self._percentile(latencies, 0.95)
+
+    def record_hedge(self, provider, won=False):
+        with self._lock:
+            self._state[provider['name']]['hedge_wins' if won else 'hedges'] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = []
+            for provider in self.providers:
+                state = self._state[provider['name']]
+                p50 = self._percentile(state['latencies'], 0.5)
+                p95 = self._percentile(state['latencies'], 0.95)
+                stats.append({
+                    'name': provider['name'],
+                    'api_base': provider['api_base'],
+                    'model': provider['model'],
+                    'weight': provider['weight'],
+                    'circuit': state['circuit'],
+                    'requests': state['requests'],
+                    'failures': state['failures'],
+                    'hedges': state['hedges'],
+                    'hedge_wins': state['hedge_wins'],
+                    'p50_ms': round(p50 * 1000) if p50 is not None else None,
+                    'p95_ms': round(p95 * 1000) if p95 is not None else None
+                })
+            return stats
+
+provider_router = ProviderRouter(
+    load_providers(),
+    window=config.PROVIDER_LATENCY_WINDOW,
+    failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=config.CIRCUIT_RESET_TIMEOUT
+)
+
 # --- Existing Helper Functions ---
 
+class CounterStore:
+    """计数器：SQLite 事务内原子自增，多个工作进程同时计数不会丢失"""
+
+    def __init__(self, db_path, legacy_files=None):
+        self.db_path = db_path
+        # 旧版计数文件 {计数器名: 文件路径}，计数器首次创建时导入
+        self.legacy_files = legacy_files or {}
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = get_sqlite_connection(self.db_path)
+        if not self._schema_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            """)
+            for name, path in self.legacy_files.items():
+                conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)", (name, self._read_legacy(path)))
+            self._schema_ready = True
+        return conn
+
+    @staticmethod
+    def _read_legacy(path):
+        try:
+            with open(path, 'r') as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    def get(self, name):
+        row = self._conn().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def increment(self, name, amount=1):
+        """自增并返回新值"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                (name, amount)
+            )
+            value = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+counter_store = CounterStore(config.COUNTER_DB, legacy_files={'conversions': STATS_FILE})
+
 def get_conversion_count():
     """获取转换次数"""
     try:
-        if os.path.exists(STATS_FILE):
-            with open(STATS_FILE, 'r') as f:
-                return int(f.read().strip())
-        return 0
-    except:
+        return counter_store.get('conversions')
+    except Exception as e:
+        logger.error(f"Counter read error: {e}")
         return 0
 
 def increment_conversion_count():
     """增加转换次数"""
     try:
-        count = get_conversion_count() + 1
-        with open(STATS_FILE, 'w') as f:
-            f.write(str(count))
-        return count
-    except:
+        return counter_store.increment('conversions')
+    except Exception as e:
+        logger.error(f"Counter write error: {e}")
         return get_conversion_count()
 
+stats_cache = TTLCache(1, config.STATS_CACHE_TTL)
+
+def get_stats_snapshot():
+    """统计信息快照，按 STATS_CACHE_TTL 缓存，返回 (数据, ETag)"""
+    snapshot = stats_cache.get('stats')
+    if snapshot is None:
+        # 只包含所有工作进程共享的数据：各进程自己的缓存计数见 /stats/details，
+        # 放进来会让轮询落到不同进程时 ETag 来回变化
+        payload = {'total_conversions': get_conversion_count()}
+        # ETag 只由统计内容决定，内容不变时轮询返回 304
+        etag = hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        payload['timestamp'] = datetime.now().isoformat()
+        snapshot = (payload, etag)
+        stats_cache.set('stats', snapshot)
+    return snapshot
+
+_api_session = None
+_api_session_pid = None
+_api_session_lock = threading.Lock()
+
+def get_api_session():
+    """获取共享的上游API会话（连接池+keep-alive，每个工作进程一个）"""
+    global _api_session, _api_session_pid
+    with _api_session_lock:
+        if _api_session is None or _api_session_pid != os.getpid():
+            session_obj = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=config.API_POOL_SIZE, pool_block=False)
+            session_obj.mount('http://', adapter)
+            session_obj.mount('https://', adapter)
+            _api_session = session_obj
+            _api_session_pid = os.getpid()
+        return _api_session
+
 def get_api_config():
     """获取API配置"""
     return {
-        'api_key': config.OPENAI_API_KEY,
-        'api_base': config.OPENAI_API_BASE,
-        'model': config.OPENAI_MODEL,
         'max_tokens': config.MODEL_MAX_TOKENS,
         'temperature': config.MODEL_TEMPERATURE,
+        'connect_timeout': config.API_CONNECT_TIMEOUT,
+        'read_timeout': config.API_READ_TIMEOUT,
+        'hedge_enabled': config.HEDGE_ENABLED,
+        'hedge_min_delay': config.HEDGE_MIN_DELAY,
+        'max_retries': config.API_MAX_RETRIES,
+        'retry_base_delay': config.API_RETRY_BASE_DELAY,
+        'retry_max_delay': config.API_RETRY_MAX_DELAY,
+        'retry_max_wait': config.API_RETRY_MAX_WAIT,
+        'throttle_max_wait': config.API_THROTTLE_MAX_WAIT,
         'image_max_size': config.IMAGE_MAX_SIZE,
-        'image_quality': config.IMAGE_QUALITY
+        'image_quality': config.IMAGE_QUALITY,
+        'image_trim_enabled': config.IMAGE_TRIM_ENABLED,
+        'image_trim_padding': config.IMAGE_TRIM_PADDING,
+        'image_ink_threshold': config.IMAGE_INK_THRESHOLD,
+        'image_adaptive_enabled': config.IMAGE_ADAPTIVE_ENABLED,
+        'adaptive_min_stroke': config.ADAPTIVE_MIN_STROKE,
+        'adaptive_min_line_height': config.ADAPTIVE_MIN_LINE_HEIGHT,
+        'adaptive_baseline_sample': config.ADAPTIVE_BASELINE_SAMPLE,
+        'result_cache_enabled': config.RESULT_CACHE_ENABLED,
+        'similar_cache_enabled': config.SIMILAR_CACHE_ENABLED,
+        'coalesce_enabled': config.COALESCE_ENABLED,
+        'similar_hash_size': config.SIMILAR_CACHE_HASH_SIZE
     }
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def optimize_image(image_data, config):
-    """优化图片大小和质量"""
+def is_pdf_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in PDF_EXTENSIONS
+
+def find_ink_bands(mask, min_gap):
+    """行投影：返回含墨迹的行区间 [(top, bottom), ...]，间隔不足 min_gap 的区间合并"""
+    # 缩放到宽度 1 (BOX 滤波) 即得到每行的平均墨迹量；用浮点模式计算，
+    # 8 位模式下很宽的行里只有几个墨迹像素（小数点、细笔画）会被舍入为 0 而被裁掉
+    profile = list(mask.convert('F').resize((1, mask.height), Image.Resampling.BOX).getdata())
+    bands = []
+    start = None
+    last_ink = None
+    for y, value in enumerate(profile):
+        if value <= 0:
+            continue
+        if start is None:
+            start = y
+        elif y - last_ink > min_gap:
+            bands.append((start, last_ink + 1))
+            start = y
+        last_ink = y
+    if start is not None:
+        bands.append((start, last_ink + 1))
+    return bands
+
+def crop_to_content(img, padding, ink_threshold):
+    """裁掉空白边距，并把公式区域之间的大段空白压缩到 padding 像素
+
+    只压缩垂直方向的空白，各区域保持共同的水平范围，矩阵、对齐公式的列关系不受影响。
+    返回 (处理后的图片, 区域数)；无法识别出前景（如深色背景）时原样返回。
+    """
+    gray = img.convert('L')
+    mask = gray.point(lambda p: 255 if p < ink_threshold else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return img, 0
+    
+    # 深色背景的图片墨迹占比过高，不做处理
+    ink_ratio = list(mask.resize((1, 1), Image.Resampling.BOX).getdata())[0] / 255
+    if ink_ratio > 0.5:
+        return img, 0
+    
+    left, top, right, bottom = bbox
+    left, right = max(0, left - padding), min(img.width, right + padding)
+    content_mask = mask.crop((0, top, img.width, bottom))
+    bands = find_ink_bands(content_mask, min_gap=2 * padding)
+    
+    if len(bands) <= 1:
+        return img.crop((left, max(0, top - padding), right, min(img.height, bottom + padding))), len(bands)
+    
+    # 依次拼接各区域，区域间只保留 padding 像素空白
+    heights = [band_bottom - band_top for band_top, band_bottom in bands]
+    canvas = Image.new('RGB', (right - left, sum(heights) + padding * (len(bands) + 1)), 'white')
+    y = padding
+    for (band_top, band_bottom), height in zip(bands, heights):
+        region = img.crop((left, top + band_top, right, top + band_bottom))
+        canvas.paste(region, (0, y))
+        y += height + padding
+    return canvas, len(bands)
+
+adaptive_stats = {
+    'images': 0,
+    'escalations': 0,
+    'byte_samples': 0,
+    'baseline_bytes': 0,
+    'sent_bytes': 0,
+    'baseline_tokens': 0,
+    'sent_tokens': 0
+}
+adaptive_stats_lock = threading.Lock()
+
+def record_adaptive_stats(**values):
+    with adaptive_stats_lock:
+        for key, value in values.items():
+            adaptive_stats[key] += value
+
+def should_sample_baseline(config):
+    """每 ADAPTIVE_BASELINE_SAMPLE 张图片抽样一次，编码基线 JPEG 对比字节数"""
+    every = config['adaptive_baseline_sample']
+    if every <= 0:
+        return False
+    with adaptive_stats_lock:
+        return adaptive_stats['images'] % every == 0
+
+def get_adaptive_stats():
+    with adaptive_stats_lock:
+        stats = dict(adaptive_stats)
+    # 字节数只在抽样图片上对比，按抽样比例估算
+    stats['bytes_saved'] = stats['baseline_bytes'] - stats['sent_bytes']
+    stats['bytes_saved_ratio'] = round(stats['bytes_saved'] / stats['baseline_bytes'], 4) if stats['baseline_bytes'] else 0.0
+    stats['tokens_saved'] = stats['baseline_tokens'] - stats['sent_tokens']
+    return stats
+
+def estimate_image_tokens(width, height, detail):
+    """按 OpenAI 视觉模型的计费规则估算图片 tokens"""
+    if detail == 'low':
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def analyze_image_content(img, config):
+    """估算内容密度：墨迹占比、笔画粗细、行数和平均行高"""
+    mask = img.convert('L').point(lambda p: 255 if p < config['image_ink_threshold'] else 0)
+    ink_pixels = mask.histogram()[255]
+    edge_pixels = mask.filter(ImageFilter.FIND_EDGES).histogram()[255]
+    bands = find_ink_bands(mask, min_gap=2)
+    return {
+        'ink_ratio': ink_pixels / max(img.width * img.height, 1),
+        # 笔画面积 / 轮廓长度 ≈ 笔画半宽
+        'stroke_width': 2 * ink_pixels / edge_pixels if edge_pixels else 0,
+        'lines': len(bands),
+        'line_height': sum(bottom - top for top, bottom in bands) / len(bands) if bands else 0
+    }
+
+def encode_smallest(img, config):
+    """依次尝试 JPEG/PNG/WebP 编码，返回 (字节, MIME类型) 中最小的一个；PNG 无损，接近时优先"""
+    candidates = []
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=config['image_quality'], optimize=True)
+    candidates.append((output.getvalue(), 'image/jpeg'))
+    output = io.BytesIO()
+    img.save(output, format='PNG', optimize=True)
+    png = (output.getvalue(), 'image/png')
+    if features.check('webp'):
+        output = io.BytesIO()
+        img.save(output, format='WEBP', quality=config['image_quality'])
+        candidates.append((output.getvalue(), 'image/webp'))
+    smallest = min(candidates, key=lambda item: len(item[0]))
+    return png if len(png[0]) <= len(smallest[0]) * 1.1 else smallest
+
+def adapt_image(img, config):
+    """按内容选择最小的可读分辨率、颜色模式和细节级别，返回 (图片, detail)"""
+    analysis = analyze_image_content(img, config)
+    
+    # 缩放后笔画仍不细于 ADAPTIVE_MIN_STROKE，行高仍不低于 ADAPTIVE_MIN_LINE_HEIGHT
+    scale = 1.0
+    if analysis['stroke_width'] and analysis['line_height']:
+        scale = min(1.0, max(
+            config['adaptive_min_stroke'] / analysis['stroke_width'],
+            config['adaptive_min_line_height'] / analysis['line_height']
+        ))
+    if scale < 1.0:
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    
+    # 基本无彩色的图片使用灰度
+    saturation = ImageStat.Stat(img.convert('HSV').getchannel('S')).mean[0]
+    if saturation < 16:
+        img = img.convert('L')
+    
+    # 不超过 512px 时 low 与 high 看到的像素相同，low 只计 85 tokens
+    detail = 'low' if max(img.width, img.height) <= 512 else 'high'
+    logger.info(
+        f"自适应压缩: 墨迹占比 {analysis['ink_ratio']:.1%}, 笔画 {analysis['stroke_width']:.1f}px, "
+        f"{analysis['lines']} 行, 缩放 {scale:.2f}, 模式 {img.mode}, detail {detail}"
+    )
+    return img, detail
+
+def optimize_image(image, config, info=None):
+    """优化图片大小和质量；传入 info 字典时顺带写入感知哈希等附加信息"""
     try:
-        # 解码base64图片
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
-        img_bytes = base64.b64decode(image_data)
-        img = Image.open(io.BytesIO(img_bytes))
+        # 使用共享的已解码图片，后续处理均生成新对象，不修改原图
+        img = image.image
         
         # 转换为RGB模式（如果需要）
         if img.mode != 'RGB':
             img = img.convert('RGB')
         
+        original_pixels = img.width * img.height
+        regions = 0
+        
+        # 只保留公式区域，减少发送给模型的像素
+        if config['image_trim_enabled']:
+            img, regions = crop_to_content(img, config['image_trim_padding'], config['image_ink_threshold'])
+        
         # 调整图片大小
         max_size = (config['image_max_size'], config['image_max_size'])
+        if img is image.image:
+            img = img.copy()
         img.thumbnail(max_size, Image.Resampling.LANCZOS)
         
-        # 保存为优化后的JPEG
-        output = io.BytesIO()
-        img.save(output, format='JPEG', quality=config['image_quality'], optimize=True)
+        baseline_img = img
+        detail = 'high'
+        if config['image_adaptive_enabled']:
+            img, detail = adapt_image(img, config)
+        
+        if info is not None and config['similar_cache_enabled']:
+            try:
+                info['dhash'] = compute_image_dhash(img, config['similar_hash_size'])
+            except Exception as e:
+                logger.error(f"感知哈希计算失败: {e}")
+        
+        if config['image_adaptive_enabled']:
+            optimized_bytes, mime_type = encode_smallest(img, config)
+        else:
+            # 保存为优化后的JPEG
+            output = io.BytesIO()
+            img.save(output, format='JPEG', quality=config['image_quality'], optimize=True)
+            optimized_bytes, mime_type = output.getvalue(), 'image/jpeg'
         
         # 转换回base64
-        optimized_b64 = base64.b64encode(output.getvalue()).decode('utf-8')
+        optimized_b64 = base64.b64encode(optimized_bytes).decode('utf-8')
+        
+        sent_pixels = img.width * img.height
+        sent_bytes = len(optimized_bytes)
+        logger.info(
+            f"图片预处理: 公式区域 {regions} 个, 像素 {original_pixels} -> {sent_pixels} (节省 {1 - sent_pixels / max(original_pixels, 1):.0%}), "
+            f"字节 {len(image.data)} -> {sent_bytes} (节省 {1 - sent_bytes / max(len(image.data), 1):.0%})"
+        )
+        # 分辨率或 detail 被自适应压缩降低时，无法识别才值得用完整分辨率重试
+        reduced = config['image_adaptive_enabled'] and (img.size != baseline_img.size or detail == 'low')
+        if config['image_adaptive_enabled']:
+            # 与非自适应模式（固定尺寸 JPEG、detail high）对比记录节省量；
+            # 基线 JPEG 只对抽样图片编码，避免每次转换都多一次编码
+            baseline_bytes = 0
+            sampled = should_sample_baseline(config)
+            if sampled:
+                output = io.BytesIO()
+                baseline_img.save(output, format='JPEG', quality=config['image_quality'], optimize=True)
+                baseline_bytes = output.tell()
+            record_adaptive_stats(
+                images=1,
+                byte_samples=int(sampled),
+                baseline_bytes=baseline_bytes,
+                sent_bytes=sent_bytes if sampled else 0,
+                baseline_tokens=estimate_image_tokens(baseline_img.width, baseline_img.height, 'high'),
+                sent_tokens=estimate_image_tokens(img.width, img.height, detail)
+            )
+        
+        if info is not None:
+            info.update({
+                'mime_type': mime_type,
+                'detail': detail,
+                'original_pixels': original_pixels,
+                'sent_pixels': sent_pixels,
+                'sent_tokens': estimate_image_tokens(img.width, img.height, detail),
+                'reduced': reduced,
+                'original_bytes': len(image.data),
+                'sent_bytes': sent_bytes
+            })
         
         return optimized_b64
     except Exception as e:
         logger.error(f"图片优化失败: {e}")
-        return image_data.split(',')[1] if ',' in image_data else image_data
+        return image.to_base64()
 
 def get_prompt_text():
     """获取AI提示词"""
@@ -422,25 +2558,100 @@ def get_prompt_text():
 分数公式：$$\\frac{a + b}{c - d} = \\frac{\\sqrt{x}}{y^2}$$
 求和公式：$$\\sum_{i=1}^{n} x_i = \\frac{n(n+1)}{2}$$"""
 
-def call_ai_api(image_base64, user_email=None):
-    """调用AI API进行数学公式识别"""
-    config = get_api_config()
+def prepare_conversion(image, config):
+    """优化图片并计算缓存键（同步转换和流式转换共用）"""
+    started = time.monotonic()
+    image_info = {}
+    optimized_image = optimize_image(image=as_uploaded_image(image), config=config, info=image_info)
+    key = make_result_cache_key(optimized_image, config)
+    return {
+        'optimized_image': optimized_image,
+        'mime_type': image_info.get('mime_type', 'image/jpeg'),
+        'detail': image_info.get('detail', 'high'),
+        'adaptive': image_info.get('reduced', False),
+        # TPM 限流按请求时的估算计：图片 + 提示词 + max_tokens（与 OpenAI 的计算方式一致）
+        'tokens': image_info.get('sent_tokens', 765) + len(get_prompt_text()) + config['max_tokens'],
+        'namespace': get_result_namespace(config),
+        'cache_key': key if config['result_cache_enabled'] else None,
+        'flight_key': key if config['coalesce_enabled'] else None,
+        'dhash': image_info.get('dhash'),
+        'started': started,
+        'original_bytes': image_info.get('original_bytes', len(image.data)),
+        'sent_bytes': image_info.get('sent_bytes', len(optimized_image) * 3 // 4)
+    }
+
+def lookup_cached_conversion(prepared, user_email=None):
+    """查找精确缓存和相似图片缓存，命中时返回转换结果，否则返回 None"""
+    # 相同图片+模型参数命中缓存时直接返回，不再调用API
+    cache_key = prepared['cache_key']
+    if cache_key:
+        cached_latex = result_cache.get(cache_key)
+        if cached_latex is not None:
+            count = increment_conversion_count()
+            logger.info(f"命中结果缓存，返回LaTeX代码长度: {len(cached_latex)}，总转换次数: {count}")
+            if user_email: log_user_action(user_email, True, usage_details(prepared, cache='exact'))
+            return {"success": True, "latex": cached_latex, "total_conversions": count, "cached": True}
     
-    if not config['api_key']:
-        if user_email: log_user_action(user_email, False)
-        return {"success": False, "error": "API密钥未配置"}
+    # 近似图片（重新截图、重新压缩、裁剪略有不同）复用历史结果
+    dhash = prepared['dhash']
+    # 空白/纯色图片哈希为 0，彼此之间不能复用结果
+    if dhash is not None and dhash[0]:
+        similar = similar_index.lookup(prepared['namespace'], *dhash)
+        if similar is not None:
+            similar_latex, distance = similar
+            if cache_key:
+                result_cache.set(cache_key, similar_latex)
+            count = increment_conversion_count()
+            logger.info(f"命中相似图片缓存 (汉明距离 {distance})，总转换次数: {count}")
+            if user_email: log_user_action(user_email, True, usage_details(prepared, cache='similar'))
+            return {"success": True, "latex": similar_latex, "total_conversions": count, "cached": True, "similar_distance": distance}
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {config['api_key']}"
-    }
+    return None
+
+def share_conversion_result(result, prepared, user_email=None):
+    """等待者复用进行中的相同请求的结果，按一次转换计数"""
+    if not result.get('success'):
+        if user_email: log_user_action(user_email, False, usage_details(prepared, cache='coalesced', error=result.get('error')))
+        return result
+    count = increment_conversion_count()
+    logger.info(f"合并到进行中的相同请求，总转换次数: {count}")
+    if user_email: log_user_action(user_email, True, usage_details(prepared, cache='coalesced'))
+    return dict(result, total_conversions=count, coalesced=True)
+
+class Flight:
+    """一次合并请求的状态：shared 为其他请求的结果；领头请求把最终结果写入 result"""
+
+    def __init__(self, shared=None):
+        self.shared = shared
+        self.result = None
+
+@contextmanager
+def coalesce_conversion(prepared, user_email=None):
+    """相同图片的并发转换只调用一次模型；领头请求未写入结果就退出时由等待者接替"""
+    key = prepared['flight_key']
+    if not key:
+        yield Flight()
+        return
     
-    # 优化图片
-    optimized_image = optimize_image(image_data=image_base64, config=config)
+    owner, shared = single_flight.begin(key)
+    if owner is None:
+        yield Flight(share_conversion_result(shared, prepared, user_email) if shared is not None else None)
+        return
     
-    # 构建请求payload
+    flight = Flight()
+    try:
+        yield flight
+    finally:
+        single_flight.finish(key, owner, flight.result)
+
+def build_api_request(provider, config, prepared, stream=False):
+    """构建发往指定上游接口的请求头和payload"""
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {provider['api_key']}"
+    }
     payload = {
-        "model": config['model'],
+        "model": provider['model'],
         "messages": [
             {
                 "role": "user",
@@ -452,8 +2663,8 @@ def call_ai_api(image_base64, user_email=None):
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{optimized_image}",
-                            "detail": "high"
+                            "url": f"data:{prepared['mime_type']};base64,{prepared['optimized_image']}",
+                            "detail": prepared['detail']
                         }
                     }
                 ]
@@ -462,48 +2673,461 @@ def call_ai_api(image_base64, user_email=None):
         "max_tokens": config['max_tokens'],
         "temperature": config['temperature']
     }
+    if stream:
+        payload['stream'] = True
+        # 最后一个数据块附带本次请求的 tokens 用量
+        payload['stream_options'] = {"include_usage": True}
+    return headers, payload
+
+def store_conversion_result(prepared, latex_code):
+    """写入精确缓存和相似图片索引；无法识别的结果不缓存，下次重新请求模型"""
+    if "无法识别" not in latex_code:
+        if prepared['cache_key']:
+            result_cache.set(prepared['cache_key'], latex_code)
+        if prepared['dhash'] is not None and prepared['dhash'][0]:
+            similar_index.add(prepared['namespace'], *prepared['dhash'], latex_code)
+
+def usage_details(prepared, cache='miss', error=None):
+    """整理一次转换的使用事件字段：耗时、图片大小、tokens 和缓存命中情况"""
+    usage = prepared.get('usage') or {}
+    return {
+        'latency_ms': round((time.monotonic() - prepared['started']) * 1000),
+        'image_bytes': prepared['original_bytes'],
+        'sent_bytes': prepared['sent_bytes'],
+        'cache': cache,
+        'provider': prepared.get('provider'),
+        'model': prepared.get('model'),
+        'prompt_tokens': usage.get('prompt_tokens'),
+        'completion_tokens': usage.get('completion_tokens'),
+        'estimated_tokens': prepared['tokens'],
+        'error': error
+    }
+
+def fail_conversion(prepared, error, user_email=None):
+    """记录失败的使用事件，返回失败结果"""
+    if user_email: log_user_action(user_email, False, usage_details(prepared, error=error))
+    return {"success": False, "error": error}
+
+def complete_conversion(prepared, latex_code, user_email=None):
+    """写入缓存、增加转换计数并记录日志，返回成功结果"""
+    store_conversion_result(prepared, latex_code)
+    
+    # 转换成功，增加计数
+    count = increment_conversion_count()
     
+    logger.info(f"API调用成功，返回LaTeX代码长度: {len(latex_code)}，总转换次数: {count}")
+    if user_email: log_user_action(user_email, True, usage_details(prepared))
+    return {"success": True, "latex": latex_code, "total_conversions": count, "cached": False}
+
+def parse_retry_after(value):
+    """解析 Retry-After 响应头（秒数或 HTTP 日期），无法解析时返回 0"""
+    if not value:
+        return 0
     try:
-        logger.info(f"正在调用API: {config['api_base']}, 模型: {config['model']}")
-        
-        response = requests.post(
-            f"{config['api_base']}/chat/completions",
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+# 密钥、权限或模型配置错误：属于该接口的故障，换其他接口重试
+PROVIDER_FAILOVER_STATUSES = (401, 403, 404)
+
+def classify_upstream_status(provider, response, failed_providers=None):
+    """非 2xx 响应的处理：记录接口健康状态和统计，返回重试等待 (None 表示不可重试)
+
+    429/5xx 计为接口故障并退避重试；401/403/404 计为接口故障，加入 failed_providers 后换接口重试；
+    其他 4xx 是请求本身的问题，不影响接口评分，也不重试。
+    """
+    status = response.status_code
+    if status == 429 or status >= 500:
+        upstream_stats.add('rate_limited' if status == 429 else 'server_errors')
+        return False, parse_retry_after(response.headers.get('Retry-After'))
+    if status in PROVIDER_FAILOVER_STATUSES:
+        upstream_stats.add('provider_errors')
+        if failed_providers is not None:
+            failed_providers.add(provider['name'])
+            return False, 0
+        return False, None
+    return None, None
+
+def call_provider(provider, config, prepared, failed_providers=None):
+    """向一个上游接口发送识别请求，并记录延迟和成败
+
+    返回 (清理后的LaTeX代码, 错误信息, 重试等待)：重试等待为 None 表示不可重试，
+    否则为服务端 Retry-After 建议的秒数（没有时为 0）。接口配置错误时把接口名加入 failed_providers。
+    """
+    # 构建请求payload
+    headers, payload = build_api_request(provider, config, prepared)
+    
+    logger.info(f"正在调用API: {provider['api_base']}, 模型: {provider['model']}")
+    
+    started = time.monotonic()
+    success = False
+    try:
+        response = get_api_session().post(
+            f"{provider['api_base']}/chat/completions",
             headers=headers, 
             json=payload, 
-            timeout=60
+            timeout=(config['connect_timeout'], config['read_timeout'])
         )
         
         logger.info(f"API请求状态码: {response.status_code}")
         
-        if response.status_code != 200:
+        if not 200 <= response.status_code < 300:
             error_text = response.text[:500] if response.text else "无响应内容"
             logger.error(f"API请求失败，状态码: {response.status_code}, 响应: {error_text}")
-            if user_email: log_user_action(user_email, False)
-            return {"success": False, "error": f"API请求失败，状态码: {response.status_code}"}
+            success, retry_after = classify_upstream_status(provider, response, failed_providers)
+            return None, f"API请求失败，状态码: {response.status_code}", retry_after
         
         result = response.json()
         
         if 'choices' not in result or len(result['choices']) == 0:
             logger.error(f"API响应格式错误: {result}")
-            if user_email: log_user_action(user_email, False)
-            return {"success": False, "error": "API响应格式错误，没有找到choices字段"}
+            return None, "API响应格式错误，没有找到choices字段", None
         
         latex_code = result['choices'][0]['message']['content'].strip()
+        success = True
+        prepared.update(provider=provider['name'], model=provider['model'], usage=result.get('usage'))
         
         # 清理和格式化LaTeX代码
-        latex_code = clean_latex_output(latex_code)
+        return clean_latex_output(latex_code), None, None
+    except requests.exceptions.RequestException as e:
+        # 连接失败、超时等网络错误可以重试
+        logger.error(f"上游接口 {provider['name']} 请求异常: {e}")
+        return None, f"处理失败: {str(e)}", 0
+    finally:
+        provider_router.record(provider, success, time.monotonic() - started)
+
+def acquire_provider(config, tokens, exclude=(), block=True):
+    """选择一个可用且配额充足的上游接口，返回 (接口, 错误信息)
+
+    所有接口的 RPM/TPM 配额都用尽时排队等待（最长 API_THROTTLE_MAX_WAIT 秒），block 为 False 时不等待。
+    """
+    deadline = time.monotonic() + config['throttle_max_wait']
+    waited = False
+    while True:
+        throttled = set(exclude)
+        shortest = None
+        while True:
+            provider = provider_router.choose(exclude=throttled)
+            if provider is None:
+                break
+            wait_seconds = upstream_limiter.acquire([
+                (f"{provider['name']}:rpm", provider['rpm'], 1),
+                (f"{provider['name']}:tpm", provider['tpm'], tokens)
+            ])
+            if not wait_seconds:
+                if waited:
+                    upstream_stats.add('throttled')
+                return provider, None
+            provider_router.release(provider)
+            throttled.add(provider['name'])
+            shortest = wait_seconds if shortest is None else min(shortest, wait_seconds)
+        
+        if shortest is None:
+            return None, "上游接口暂时不可用，请稍后再试"
+        if not block or time.monotonic() + shortest > deadline:
+            if block:
+                upstream_stats.add('throttle_rejected')
+            return None, "上游接口配额已用尽，请稍后再试"
+        waited = True
+        time.sleep(shortest)
+
+def send_completion(config, prepared, failed_providers=None):
+    """选择上游接口发送一次识别请求，返回值同 call_provider；跳过 failed_providers 中配置错误的接口
+
+    开启对冲时，首选接口超过其 p95 延迟仍未返回，就向另一个接口再发一次，采用先成功的结果。
+    """
+    if failed_providers is None:
+        failed_providers = set()
+    provider, error = acquire_provider(config, prepared['tokens'], exclude=failed_providers)
+    if provider is None:
+        return None, error, None
+    
+    delay = provider_router.hedge_delay(provider) if config['hedge_enabled'] else None
+    if delay is None:
+        return call_provider(provider, config, prepared, failed_providers)
+    
+    # 每一路请求写入自己的副本，只有采用的结果合并回 prepared，落后的请求不会覆盖接口和用量
+    attempts = {}
+    def submit(target):
+        attempt = dict(prepared)
+        future = executor.submit(call_provider, target, config, attempt, failed_providers)
+        futures[future] = target
+        attempts[future] = attempt
+    
+    executor = ThreadPoolExecutor(max_workers=2)
+    futures = {}
+    try:
+        submit(provider)
+        done, _ = wait(futures, timeout=max(delay, config['hedge_min_delay']))
+        if not done:
+            # 对冲请求不排队等待配额
+            backup, _ = acquire_provider(config, prepared['tokens'], exclude=failed_providers | {provider['name']}, block=False)
+            if backup is not None:
+                logger.info(f"上游接口 {provider['name']} 超过 p95 延迟 {delay:.2f}s 未返回，对冲请求 {backup['name']}")
+                provider_router.record_hedge(backup)
+                submit(backup)
+        
+        outcome = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    # 一路请求出错时继续等待另一路
+                    logger.error(f"上游接口 {futures[future]['name']} 处理失败: {e}")
+                    outcome = (None, f"处理失败: {str(e)}", None)
+                    continue
+                if not outcome[1]:
+                    if futures[future] is not provider:
+                        provider_router.record_hedge(futures[future], won=True)
+                    attempt = attempts[future]
+                    prepared.update(provider=attempt.get('provider'), model=attempt.get('model'), usage=attempt.get('usage'))
+                    return outcome
+        return outcome
+    finally:
+        # 落后的请求在后台完成，只用于更新延迟统计
+        executor.shutdown(wait=False)
+
+def get_retry_delay(config, attempt, retry_after):
+    """指数退避 + 完全抖动；服务端给出 Retry-After 时至少等待该时间，超过 API_RETRY_MAX_WAIT 返回 None（放弃重试）"""
+    backoff = random.uniform(0, min(config['retry_max_delay'], config['retry_base_delay'] * 2 ** attempt))
+    delay = max(backoff, retry_after)
+    return delay if delay <= config['retry_max_wait'] else None
+
+def request_completion(config, prepared):
+    """发送识别请求，429/5xx/网络错误时退避重试，接口配置错误 (401/403/404) 时换接口重试，返回 (清理后的LaTeX代码, 错误信息)"""
+    attempt = 0
+    failed_providers = set()
+    while True:
+        latex_code, error, retry_after = send_completion(config, prepared, failed_providers)
+        if retry_after is None or attempt >= config['max_retries']:
+            return latex_code, error
+        delay = get_retry_delay(config, attempt, retry_after)
+        if delay is None:
+            return latex_code, error
+        attempt += 1
+        upstream_stats.add('retries')
+        logger.warning(f"{error}，{delay:.1f} 秒后第 {attempt} 次重试")
+        time.sleep(delay)
+
+def escalate_conversion(image, config, prepared, latex_code):
+    """自适应压缩降低了分辨率或 detail 且模型无法识别时，以原始分辨率和 detail high 重试一次"""
+    if not prepared['adaptive'] or "无法识别数学公式" not in latex_code:
+        return prepared, latex_code, None
+    
+    logger.info("自适应压缩后无法识别，使用完整分辨率重试")
+    record_adaptive_stats(escalations=1)
+    full_config = dict(config, image_adaptive_enabled=False)
+    full_prepared = dict(prepare_conversion(image, full_config), started=prepared['started'])
+    full_latex, error = request_completion(full_config, full_prepared)
+    if error:
+        return prepared, None, error
+    
+    # 原始（自适应）缓存键同样记录重试结果，下次相同图片不必再次升级
+    store_conversion_result(prepared, full_latex)
+    return full_prepared, full_latex, None
+
+def call_ai_api(image, user_email=None):
+    """调用AI API进行数学公式识别"""
+    config = get_api_config()
+    
+    if not provider_router.providers:
+        if user_email: log_user_action(user_email, False)
+        return {"success": False, "error": "API密钥未配置"}
+    
+    # 优化图片
+    image = as_uploaded_image(image)
+    prepared = prepare_conversion(image, config)
+    
+    cached = lookup_cached_conversion(prepared, user_email)
+    if cached is not None:
+        return cached
+    
+    # 相同图片的并发请求只调用一次模型
+    with coalesce_conversion(prepared, user_email) as flight:
+        if flight.shared is not None:
+            return flight.shared
+        # 上传、流式和任务队列的转换共用按用户轮转的模型调用名额
+        with conversion_gate.slot(user_email or '') as admitted:
+            if not admitted:
+                flight.result = fail_conversion(prepared, "服务繁忙，请稍后再试", user_email)
+            else:
+                flight.result = convert_with_model(image, config, prepared, user_email)
+        return flight.result
+
+def convert_with_model(image, config, prepared, user_email=None):
+    """缓存未命中时调用模型识别，返回转换结果"""
+    try:
+        latex_code, error = request_completion(config, prepared)
+        if not error:
+            prepared, latex_code, error = escalate_conversion(image, config, prepared, latex_code)
         
-        # 转换成功，增加计数
-        count = increment_conversion_count()
+        if error:
+            return fail_conversion(prepared, error, user_email)
         
-        logger.info(f"API调用成功，返回LaTeX代码长度: {len(latex_code)}，总转换次数: {count}")
-        if user_email: log_user_action(user_email, True)
-        return {"success": True, "latex": latex_code, "total_conversions": count}
+        return complete_conversion(prepared, latex_code, user_email)
     
     except Exception as e:
         logger.error(f"处理失败: {e}")
+        return fail_conversion(prepared, f"处理失败: {str(e)}", user_email)
+
+def clean_partial_latex(text):
+    """流式输出过程中的清理：只对已完整的行应用 clean_latex_output，最后一行原样保留"""
+    text = text.replace('```latex', '').replace('```LaTeX', '').replace('```tex', '').replace('```', '')
+    if '\n' not in text:
+        return text.strip()
+    complete, tail = text.rsplit('\n', 1)
+    cleaned = clean_latex_output(complete)
+    return f"{cleaned}\n{tail.strip()}" if tail.strip() else cleaned
+
+def stream_ai_api(image, user_email=None):
+    """以 stream 模式调用AI API，逐步产出 (事件名, 数据) 元组，最后产出 done 事件"""
+    config = get_api_config()
+    
+    if not provider_router.providers:
         if user_email: log_user_action(user_email, False)
-        return {"success": False, "error": f"处理失败: {str(e)}"}
+        yield 'done', {"success": False, "error": "API密钥未配置"}
+        return
+    
+    image = as_uploaded_image(image)
+    prepared = prepare_conversion(image, config)
+    
+    cached = lookup_cached_conversion(prepared, user_email)
+    if cached is not None:
+        yield 'done', cached
+        return
+    
+    # 等待者不接收增量内容，只在领头请求完成后收到最终结果
+    with coalesce_conversion(prepared, user_email) as flight:
+        if flight.shared is not None:
+            yield 'done', flight.shared
+            return
+        with conversion_gate.slot(user_email or '') as admitted:
+            if not admitted:
+                flight.result = fail_conversion(prepared, "服务繁忙，请稍后再试", user_email)
+                yield 'done', flight.result
+                return
+            for event, data in stream_with_model(image, config, prepared, user_email):
+                if event == 'done':
+                    flight.result = data
+                yield event, data
+
+def stream_with_model(image, config, prepared, user_email=None):
+    """缓存未命中时以 stream 模式调用模型，逐步产出 (事件名, 数据)
+
+    流式请求不做对冲；收到第一段内容之前遇到 429/5xx/网络错误时退避重试，接口配置错误时换接口重试。
+    """
+    attempt = 0
+    failed_providers = set()
+    while True:
+        provider, error = acquire_provider(config, prepared['tokens'], exclude=failed_providers)
+        if provider is None:
+            yield 'done', fail_conversion(prepared, error, user_email)
+            return
+        
+        headers, payload = build_api_request(provider, config, prepared, stream=True)
+        
+        started = time.monotonic()
+        recorded = False
+        retry_after = None
+        full_text = ''
+        usage = None
+        try:
+            logger.info(f"正在调用API (流式): {provider['api_base']}, 模型: {provider['model']}")
+            
+            with get_api_session().post(
+                f"{provider['api_base']}/chat/completions",
+                headers=headers,
+                json=payload,
+                timeout=(config['connect_timeout'], config['read_timeout']),
+                stream=True
+            ) as response:
+                if not 200 <= response.status_code < 300:
+                    error_text = response.text[:500] if response.text else "无响应内容"
+                    logger.error(f"API请求失败，状态码: {response.status_code}, 响应: {error_text}")
+                    success, retry_after = classify_upstream_status(provider, response, failed_providers)
+                    provider_router.record(provider, success, time.monotonic() - started)
+                    recorded = True
+                    error = f"API请求失败，状态码: {response.status_code}"
+                else:
+                    for line in response.iter_lines(chunk_size=None):
+                        if not line or not line.startswith(b'data:'):
+                            continue
+                        data = line[5:].strip()
+                        if data == b'[DONE]':
+                            break
+                        chunk = json.loads(data)
+                        usage = chunk.get('usage') or usage
+                        choices = chunk.get('choices') or []
+                        delta = choices[0].get('delta', {}).get('content') if choices else None
+                        if delta:
+                            full_text += delta
+                            yield 'delta', {"latex": clean_partial_latex(full_text)}
+            
+            if not recorded:
+                provider_router.record(provider, bool(full_text.strip()), time.monotonic() - started)
+                recorded = True
+                prepared.update(provider=provider['name'], model=provider['model'], usage=usage)
+            elif retry_after is not None and attempt < config['max_retries']:
+                delay = get_retry_delay(config, attempt, retry_after)
+                if delay is not None:
+                    attempt += 1
+                    upstream_stats.add('retries')
+                    logger.warning(f"{error}，{delay:.1f} 秒后第 {attempt} 次重试")
+                    time.sleep(delay)
+                    continue
+            
+            if error:
+                yield 'done', fail_conversion(prepared, error, user_email)
+                return
+            
+            if not full_text.strip():
+                logger.error("API流式响应为空")
+                yield 'done', fail_conversion(prepared, "API响应为空", user_email)
+                return
+            
+            latex_code = clean_latex_output(full_text.strip())
+            prepared, latex_code, error = escalate_conversion(image, config, prepared, latex_code)
+            if error:
+                yield 'done', fail_conversion(prepared, error, user_email)
+                return
+            
+            yield 'done', complete_conversion(prepared, latex_code, user_email)
+            return
+        
+        except requests.exceptions.RequestException as e:
+            # 连接失败、超时等网络错误：还没有发出任何内容时可以重试
+            logger.error(f"上游接口 {provider['name']} 流式请求异常: {e}")
+            provider_router.record(provider, False, time.monotonic() - started)
+            recorded = True
+            if not full_text and attempt < config['max_retries']:
+                delay = get_retry_delay(config, attempt, 0)
+                if delay is not None:
+                    attempt += 1
+                    upstream_stats.add('retries')
+                    logger.warning(f"流式请求异常，{delay:.1f} 秒后第 {attempt} 次重试")
+                    time.sleep(delay)
+                    continue
+            yield 'done', fail_conversion(prepared, f"处理失败: {str(e)}", user_email)
+            return
+        except Exception as e:
+            logger.error(f"流式处理失败: {e}")
+            if not recorded:
+                provider_router.record(provider, False, time.monotonic() - started)
+                recorded = True
+            yield 'done', fail_conversion(prepared, f"处理失败: {str(e)}", user_email)
+            return
+        finally:
+            # 客户端中途断开不算接口故障，只释放半开状态的探测名额
+            if not recorded:
+                provider_router.release(provider)
 
 def clean_latex_output(latex_code):
     """清理和格式化LaTeX输出"""
@@ -685,8 +3309,419 @@ def create_word_document_with_formula(latex_code):
         logger.error(f"创建Word文档失败: {e}")
         raise e
 
+# --- Job Queue ---
+
+class FairQueue:
+    """按用户轮转出队的有界队列：每个用户一个子队列，依次从各用户取任务，任务多的用户不会让其他用户一直等待"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._queues = OrderedDict()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def put_nowait(self, owner, item):
+        with self._cond:
+            if self.maxsize and self._size >= self.maxsize:
+                raise queue.Full
+            self._queues.setdefault(owner, deque()).append(item)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self):
+        with self._cond:
+            while not self._size:
+                self._cond.wait()
+            owner, items = self._queues.popitem(last=False)
+            item = items.popleft()
+            # 取出一个任务后该用户排到队尾
+            if items:
+                self._queues[owner] = items
+            self._size -= 1
+            return item
+
+    def qsize(self):
+        with self._cond:
+            return self._size
+
+    def owner_count(self):
+        with self._cond:
+            return len(self._queues)
+
+class FairGate:
+    """限制每个进程同时调用模型的转换数，名额按用户轮转分配
+
+    名额用完时请求排队；释放名额时从各用户的等待队列依次取一个，某个用户一次提交很多请求，
+    其他用户的请求也不会排在他后面一直等待。
+    """
+
+    def __init__(self, limit, wait_timeout):
+        self.limit = limit
+        self.wait_timeout = wait_timeout
+        self._active = 0
+        self._waiters = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'admitted': 0, 'queued': 0, 'timeouts': 0}
+
+    def acquire(self, owner):
+        """获取一个名额，等待超时返回 False"""
+        if self.limit <= 0:
+            return True
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                self.stats['admitted'] += 1
+                return True
+            event = threading.Event()
+            self._waiters.setdefault(owner, deque()).append(event)
+            self.stats['queued'] += 1
+        
+        if event.wait(self.wait_timeout):
+            return True
+        with self._lock:
+            # 超时的同时恰好被分配到名额
+            if event.is_set():
+                return True
+            waiters = self._waiters.get(owner)
+            if waiters is not None:
+                waiters.remove(event)
+                if not waiters:
+                    del self._waiters[owner]
+            self.stats['timeouts'] += 1
+            return False
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            if not self._waiters:
+                self._active -= 1
+                return
+            # 名额直接交给下一个用户的第一个请求，该用户排到队尾
+            owner, waiters = self._waiters.popitem(last=False)
+            event = waiters.popleft()
+            if waiters:
+                self._waiters[owner] = waiters
+            self.stats['admitted'] += 1
+            event.set()
+
+    @contextmanager
+    def slot(self, owner):
+        """with gate.slot(用户) as admitted: admitted 为 False 表示排队超时"""
+        admitted = self.acquire(owner)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['active'] = self._active
+            stats['waiting'] = sum(len(waiters) for waiters in self._waiters.values())
+            stats['waiting_users'] = len(self._waiters)
+            stats['limit'] = self.limit
+            return stats
+
+conversion_gate = FairGate(config.CONVERSION_CONCURRENCY, config.CONVERSION_QUEUE_TIMEOUT)
+
+class JobManager:
+    """转换任务队列：按用户轮转的有界队列 + 后台工作线程，任务状态保存在 SQLite 中，任意工作进程都可查询"""
+
+    def __init__(self, db_path, workers, queue_size, per_user_limit, job_timeout, result_ttl):
+        self.db_path = db_path
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_user_limit = per_user_limit
+        self.job_timeout = job_timeout
+        self.result_ttl = result_ttl
+        self._queue = None
+        self._pid = None
+        self._events = {}
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected_queue_full': 0, 'rejected_user_limit': 0}
+
+    def _conn(self):
+        conn = get_sqlite_connection(self.db_path)
+        if not self._schema_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    email TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_email_status ON jobs (email, status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs (updated_at)")
+            self._schema_ready = True
+        return conn
+
+    def _ensure_workers(self):
+        # 工作线程在首次提交时按进程启动（gunicorn fork 之后）
+        with self._lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = FairQueue(self.queue_size)
+                self._pid = os.getpid()
+                self._events = {}
+                for i in range(self.workers):
+                    threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+            return self._queue
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def active_count(self, email):
+        """用户排队中和执行中的任务数（超时任务不计入）"""
+        row = self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE email = ? AND status IN ('queued', 'running') AND created_at > ?",
+            (email, time.time() - self.job_timeout)
+        ).fetchone()
+        return row[0]
+
+    def submit(self, email, func, *args):
+        """提交任务，返回 (job_id, 错误信息, HTTP状态码)"""
+        job_queue = self._ensure_workers()
+        if self.per_user_limit and self.active_count(email) >= self.per_user_limit:
+            self._count('rejected_user_limit')
+            return None, f"同时进行的转换任务过多（上限 {self.per_user_limit} 个），请稍后再试", 429
+
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO jobs (id, email, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, email, now, now)
+        )
+        with self._lock:
+            self._events[job_id] = threading.Event()
+        try:
+            job_queue.put_nowait(email, (job_id, func, args))
+        except queue.Full:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            with self._lock:
+                self._events.pop(job_id, None)
+            self._count('rejected_queue_full')
+            return None, "服务器繁忙，请稍后再试", 503
+
+        self._count('submitted')
+        self._cleanup(conn, now)
+        return job_id, None, 202
+
+    def _cleanup(self, conn, now):
+        conn.execute("DELETE FROM jobs WHERE updated_at < ?", (now - self.result_ttl,))
+
+    def _worker(self):
+        while True:
+            job_id, func, args = self._queue.get()
+            try:
+                self._conn().execute(
+                    "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (time.time(), job_id)
+                )
+                try:
+                    result = func(*args)
+                except Exception as e:
+                    logger.error(f"任务 {job_id} 执行失败: {e}")
+                    result = {'success': False, 'error': f'处理失败: {str(e)}'}
+                self._conn().execute(
+                    "UPDATE jobs SET status = 'finished', result = ?, updated_at = ? WHERE id = ?",
+                    (json.dumps(result, ensure_ascii=False), time.time(), job_id)
+                )
+                self._count('completed' if result.get('success') else 'failed')
+            except Exception as e:
+                logger.error(f"任务 {job_id} 状态更新失败: {e}")
+            finally:
+                with self._lock:
+                    event = self._events.pop(job_id, None)
+                if event:
+                    event.set()
+
+    def get(self, job_id):
+        row = self._conn().execute(
+            "SELECT id, email, status, result, created_at FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if not row:
+            return None
+        job = {'job_id': row[0], 'email': row[1], 'status': row[2], 'created_at': row[4]}
+        if row[3]:
+            job['result'] = json.loads(row[3])
+        elif time.time() - row[4] > self.job_timeout:
+            # 执行任务的进程已退出或任务卡死
+            job['status'] = 'finished'
+            job['result'] = {'success': False, 'error': '任务超时，请重试'}
+        return job
+
+    def wait(self, job_id, timeout):
+        """长轮询：等待任务完成或超时，返回最新任务状态"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] == 'finished' or remaining <= 0:
+                return job
+            with self._lock:
+                event = self._events.get(job_id)
+            # 本进程内的任务可被立即唤醒，其他进程的任务按间隔轮询
+            if event:
+                event.wait(min(remaining, 1.0))
+            else:
+                time.sleep(min(remaining, 0.5))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            local = self._queue is not None and self._pid == os.getpid()
+            stats['queue_depth'] = self._queue.qsize() if local else 0
+            stats['queued_users'] = self._queue.owner_count() if local else 0
+        stats['workers'] = self.workers
+        stats['queue_size'] = self.queue_size
+        return stats
+
+job_manager = JobManager(
+    config.JOB_DB,
+    workers=config.JOB_WORKERS,
+    queue_size=config.JOB_QUEUE_SIZE,
+    per_user_limit=config.JOB_MAX_PER_USER,
+    job_timeout=config.JOB_TIMEOUT,
+    result_ttl=config.JOB_RESULT_TTL
+)
+
+def run_conversion(image, user_email):
+    """完整的一次转换：调用API并保存用户历史记录"""
+    result = call_ai_api(image, user_email=user_email)
+    if user_email:
+        latex_result = result.get('latex', result.get('error', '')) if result else ''
+        save_user_history(user_email, image, latex_result, result.get('success', False))
+    return result
+
+def run_queued_conversion(image, user_email):
+    """任务队列中的一次转换：排队期间只保留原始字节，此时重新解码，结束后释放解码结果"""
+    try:
+        return run_conversion(image, user_email)
+    finally:
+        image.release()
+
+def convert_batch_image(image, user_email):
+    """批量转换中的一张图片：此时才解码，转换结束后释放解码结果"""
+    try:
+        error = validate_image(image)
+        if error:
+            return {'success': False, 'error': error}
+        return call_ai_api(image, user_email)
+    finally:
+        image.release()
+
+def iter_batch_conversion(images, user_email):
+    """并发转换一批图片，按完成顺序产出 (序号, 结果)；批内相同图片只调用一次模型"""
+    groups = OrderedDict()
+    for index, image in enumerate(images):
+        groups.setdefault(image.digest(), []).append(index)
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(config.BATCH_CONCURRENCY, len(groups)))) as executor:
+        futures = {
+            executor.submit(convert_batch_image, images[indexes[0]], user_email): indexes
+            for indexes in groups.values()
+        }
+        for future in as_completed(futures):
+            indexes = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"批量转换失败: {e}")
+                result = {'success': False, 'error': f'处理失败: {str(e)}'}
+            for index in indexes:
+                item_result = result if index == indexes[0] else dict(result, duplicate_of=indexes[0])
+                if user_email:
+                    latex_result = result.get('latex', result.get('error', ''))
+                    save_user_history(user_email, images[index], latex_result, result.get('success', False))
+                yield index, item_result
+
+# pdfium 不是线程安全的（不同文档之间也不行），所有 pypdfium2 调用都在这把锁内进行
+pdfium_lock = threading.Lock()
+
+def count_pdf_pages(pdf_bytes):
+    """PDF页数（只解析文档结构，不栅格化）；无法读取时按 1 页计"""
+    try:
+        import pypdfium2 as pdfium
+        with pdfium_lock:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                return max(1, len(pdf))
+            finally:
+                pdf.close()
+    except Exception:
+        return 1
+
+def iter_pdf_conversion(pdf_bytes, user_email):
+    """逐页栅格化PDF并并发识别，按完成顺序产出 (事件名, 数据)
+
+    页面在工作线程空闲时才栅格化，同一时刻最多只有 PDF_CONCURRENCY 页的位图在内存中，
+    内存占用与总页数无关。
+    """
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        yield 'done', {'success': False, 'error': 'PDF支持未安装 (需要 pypdfium2)'}
+        return
+    
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        page_count = len(pdf)
+    try:
+        if page_count > config.PDF_MAX_PAGES:
+            yield 'done', {'success': False, 'error': f'PDF页数过多 ({page_count} 页)，最多支持 {config.PDF_MAX_PAGES} 页'}
+            return
+        
+        yield 'start', {'pages': page_count}
+        
+        def convert_page(index):
+            with pdfium_lock:
+                page = pdf[index]
+                try:
+                    img = page.render(scale=config.PDF_RENDER_DPI / 72).to_pil()
+                finally:
+                    page.close()
+            return run_conversion(UploadedImage(image=img.convert('RGB')), user_email)
+        
+        concurrency = max(1, min(config.PDF_CONCURRENCY, page_count))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {}
+            next_page = 0
+            while next_page < page_count or pending:
+                while next_page < page_count and len(pending) < concurrency:
+                    pending[executor.submit(convert_page, next_page)] = next_page
+                    next_page += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"PDF第 {index + 1} 页处理失败: {e}")
+                        result = {'success': False, 'error': f'处理失败: {str(e)}'}
+                    yield 'page', {'index': index, 'result': result}
+        
+        yield 'done', {'success': True, 'pages': page_count}
+    finally:
+        with pdfium_lock:
+            pdf.close()
+
+def format_sse(event, payload):
+    """格式化一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
 # --- Routes ---
 
+@app.before_request
+def start_background_tasks():
+    """每个工作进程收到第一个请求时启动后台维护线程（gunicorn fork 之后）"""
+    history_maintenance.start()
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -695,6 +3730,7 @@ def login():
         
         success, message = check_login(email, password)
         if success:
+            invalidate_user_session_cache(email)
             session['user_email'] = email
             return redirect(url_for('index'))
         else:
@@ -704,7 +3740,9 @@ def login():
 
 @app.route('/logout')
 def logout():
-    session.pop('user_email', None)
+    email = session.pop('user_email', None)
+    if email:
+        invalidate_user_session_cache(email)
     return redirect(url_for('login'))
 
 @app.route('/')
@@ -717,67 +3755,73 @@ def index():
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'error': '没有上传文件'})
+    file = request.files.get('file')
     
-    file = request.files['file']
+    if file is None and not is_binary_request():
+        return jsonify({'success': False, 'error': '没有上传文件'})
     
-    if file.filename == '':
-        return jsonify({'success': False, 'error': '没有选择文件'})
+    if file and is_pdf_file(file.filename):
+        # PDF 按页流式返回结果 (Server-Sent Events)
+        pdf_bytes = file.read()
+        # 超过页数上限的 PDF 不会转换，先拒绝，不消耗配额
+        page_count = count_pdf_pages(pdf_bytes)
+        if page_count > config.PDF_MAX_PAGES:
+            return jsonify({'success': False, 'error': f'PDF页数过多 ({page_count} 页)，最多支持 {config.PDF_MAX_PAGES} 页'})
+        # 每页消耗一次转换配额
+        limited = check_user_rate(page_count)
+        if limited is not None:
+            return limited
+        user_email = session.get('user_email')
+        logger.info(f"接收到PDF文件，大小: {len(pdf_bytes)} 字节")
+        
+        def generate():
+            try:
+                for event, payload in iter_pdf_conversion(pdf_bytes, user_email):
+                    yield format_sse(event, payload)
+            except Exception as e:
+                logger.error(f"PDF处理错误: {e}")
+                yield format_sse('done', {'success': False, 'error': f'处理PDF时出错: {str(e)}'})
+        
+        return Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
     
-    if file and allowed_file(file.filename):
-        try:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            
-            # 转换为base64
-            with open(filepath, "rb") as image_file:
-                image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
-            
-            # 调用API
-            result = call_ai_api(image_base64, user_email=session.get('user_email'))
-            
-            # 保存用户历史记录
-            user_email = session.get('user_email')
-            if user_email:
-                latex_result = result.get('latex', result.get('error', '')) if result else ''
-                save_user_history(user_email, image_base64, latex_result, result.get('success', False))
-            
-            # 删除临时文件
-            os.remove(filepath)
-            
-            return jsonify(result)
-            
-        except Exception as e:
-            logger.error(f"文件处理错误: {e}")
-            if 'user_email' in session:
-                log_user_action(session['user_email'], False)
-            return jsonify({'success': False, 'error': f'处理文件时出错: {str(e)}'})
+    limited = check_user_rate()
+    if limited is not None:
+        return limited
     
-    return jsonify({'success': False, 'error': '不支持的文件格式'})
+    try:
+        # 图片只保留在内存中，不写临时文件
+        image, error = read_request_image()
+        if error:
+            return jsonify({'success': False, 'error': error})
+        
+        # 调用API并保存用户历史记录
+        result = run_conversion(image, session.get('user_email'))
+        
+        return jsonify(result)
+        
+    except Exception as e:
+        logger.error(f"文件处理错误: {e}")
+        if 'user_email' in session:
+            log_user_action(session['user_email'], False)
+        return jsonify({'success': False, 'error': f'处理文件时出错: {str(e)}'})
 
 @app.route('/upload_base64', methods=['POST'])
 @login_required
+@rate_limited
 def upload_base64():
     """处理粘贴的图片数据"""
     try:
-        data = request.json
-        image_data = data.get('image')
-        
-        if not image_data:
-            return jsonify({'success': False, 'error': '没有图片数据'})
+        image, error = read_request_image()
+        if error:
+            return jsonify({'success': False, 'error': error})
         
         logger.info("接收到图片数据，开始转换")
         
-        # 调用API
-        result = call_ai_api(image_data, user_email=session.get('user_email'))
-        
-        # 保存用户历史记录
-        user_email = session.get('user_email')
-        if user_email:
-            latex_result = result.get('latex', result.get('error', '')) if result else ''
-            save_user_history(user_email, image_data, latex_result, result.get('success', False))
+        # 调用API并保存用户历史记录
+        result = run_conversion(image, session.get('user_email'))
         
         return jsonify(result)
         
@@ -787,6 +3831,302 @@ def upload_base64():
             log_user_action(session['user_email'], False)
         return jsonify({'success': False, 'error': f'处理数据时出错: {str(e)}'})
 
+@app.route('/upload_batch', methods=['POST'])
+@login_required
+def upload_batch():
+    """批量转换：multipart 多文件 (files) 或 JSON 数组 (images)，?stream=1 时按完成顺序以 SSE 返回"""
+    try:
+        if request.files:
+            images = []
+            for file in request.files.getlist('files'):
+                if file.filename == '' or not allowed_file(file.filename):
+                    return jsonify({'success': False, 'error': f'不支持的文件格式: {file.filename}'})
+                images.append(UploadedImage(data=file.read()))
+        else:
+            data = request.get_json(silent=True) or {}
+            images = [UploadedImage.from_base64(image) for image in data.get('images') or [] if image]
+        
+        if not images:
+            return jsonify({'success': False, 'error': '没有图片数据'})
+        
+        if len(images) > config.BATCH_MAX_IMAGES:
+            return jsonify({'success': False, 'error': f'单次最多转换 {config.BATCH_MAX_IMAGES} 张图片'})
+        
+        # 先只检查文件头，像素在转换时逐张解码，不会同时占用整批图片的内存
+        for index, image in enumerate(images):
+            error = validate_image(image, decode=False)
+            if error:
+                return jsonify({'success': False, 'error': f'第 {index + 1} 张图片: {error}'})
+        
+        # 每张图片消耗一次转换配额
+        limited = check_user_rate(len(images))
+        if limited is not None:
+            return limited
+        
+        logger.info(f"接收到批量转换请求，共 {len(images)} 张图片")
+        user_email = session.get('user_email')
+        
+        if request.args.get('stream'):
+            def generate():
+                for index, result in iter_batch_conversion(images, user_email):
+                    yield format_sse('item', {'index': index, 'result': result})
+                yield format_sse('done', {'success': True, 'count': len(images)})
+            
+            return Response(generate(), mimetype='text/event-stream', headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+        
+        results = [None] * len(images)
+        for index, result in iter_batch_conversion(images, user_email):
+            results[index] = result
+        return jsonify({'success': True, 'results': results})
+        
+    except Exception as e:
+        logger.error(f"批量处理错误: {e}")
+        return jsonify({'success': False, 'error': f'批量处理时出错: {str(e)}'})
+
+@app.route('/upload_stream', methods=['POST'])
+@login_required
+@rate_limited
+def upload_stream():
+    """流式转换：以 Server-Sent Events 逐步返回模型输出的 LaTeX"""
+    try:
+        image, error = read_request_image()
+    except Exception as e:
+        logger.error(f"图片读取错误: {e}")
+        return jsonify({'success': False, 'error': f'处理数据时出错: {str(e)}'})
+    
+    if error:
+        return jsonify({'success': False, 'error': error})
+    
+    user_email = session.get('user_email')
+    
+    def generate():
+        for event, payload in stream_ai_api(image, user_email=user_email):
+            if event == 'done' and user_email:
+                latex_result = payload.get('latex', payload.get('error', ''))
+                save_user_history(user_email, image, latex_result, payload.get('success', False))
+            yield format_sse(event, payload)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/jobs', methods=['POST'])
+@login_required
+@rate_limited
+def submit_job():
+    """提交异步转换任务，立即返回任务ID"""
+    try:
+        image, error = read_request_image()
+        if error:
+            return jsonify({'success': False, 'error': error})
+        
+        # 校验时解码的图片不随任务排队，队列中只保留原始字节
+        image.release()
+        user_email = session['user_email']
+        job_id, error, status_code = job_manager.submit(user_email, run_queued_conversion, image, user_email)
+        if not job_id:
+            return jsonify({'success': False, 'error': error}), status_code
+        
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'queued'}), status_code
+        
+    except Exception as e:
+        logger.error(f"任务提交错误: {e}")
+        return jsonify({'success': False, 'error': f'提交任务时出错: {str(e)}'})
+
+@app.route('/jobs/<job_id>')
+@login_required
+def get_job(job_id):
+    """查询任务状态，wait 参数指定长轮询最长等待秒数"""
+    wait = min(max(request.args.get('wait', 0, type=float), 0), config.JOB_POLL_MAX_WAIT)
+    job = job_manager.wait(job_id, wait) if wait else job_manager.get(job_id)
+    if not job or job['email'] != session['user_email']:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+    
+    response = {'success': True, 'job_id': job['job_id'], 'status': job['status']}
+    if 'result' in job:
+        response['result'] = job['result']
+    return jsonify(response)
+
+def parse_history_filters(args):
+    """解析历史记录查询参数，返回 (查询条件, 错误信息)；日期为 YYYY-MM-DD，until 当天包含在内"""
+    filters = {}
+    try:
+        if args.get('since'):
+            filters['since'] = datetime.strptime(args['since'], '%Y-%m-%d').timestamp()
+        if args.get('until'):
+            filters['until'] = (datetime.strptime(args['until'], '%Y-%m-%d') + timedelta(days=1)).timestamp()
+    except ValueError:
+        return None, '日期格式应为 YYYY-MM-DD'
+    
+    if args.get('success') in ('true', 'false'):
+        filters['success'] = args['success'] == 'true'
+    if args.get('q', '').strip():
+        filters['search'] = args['q'].strip()
+    
+    # 普通用户只能查看自己的记录；管理员默认查看所有用户，可按邮箱筛选
+    if g.user_role == 'admin':
+        filters['email'] = args.get('email', '').strip() or None
+    else:
+        filters['email'] = session['user_email']
+    return filters, None
+
+def can_view_history(entry):
+    return entry is not None and (g.user_role == 'admin' or entry['email'] == session['user_email'])
+
+@app.route('/history')
+@login_required
+def history_page():
+    return render_template('history.html', user_email=session.get('user_email'), is_admin=g.user_role == 'admin')
+
+@app.route('/history/entries')
+@login_required
+def history_entries():
+    """分页查询历史记录：before 为上一页返回的 next_before，limit 为每页条数"""
+    filters, error = parse_history_filters(request.args)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    limit = min(max(request.args.get('limit', config.HISTORY_PAGE_SIZE, type=int), 1), config.HISTORY_PAGE_MAX)
+    before = request.args.get('before', type=int)
+    
+    entries = history_store.query(before=before, limit=limit, **filters)
+    for entry in entries:
+        entry['created_at'] = datetime.fromtimestamp(entry['created_at']).isoformat()
+        entry['has_image'] = entry.pop('image_hash') is not None
+    next_before = entries[-1]['id'] if len(entries) == limit else None
+    return jsonify({'success': True, 'entries': entries, 'next_before': next_before})
+
+class StreamBuffer:
+    """只写、不可 seek 的文件对象：zipfile 写入的数据暂存在这里，由响应生成器逐块取走"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_history(filters):
+    """按页遍历符合条件的全部历史记录 (keyset 分页，内存中只保留一页)"""
+    before = None
+    while True:
+        entries = history_store.query(before=before, limit=config.HISTORY_EXPORT_PAGE_SIZE, **filters)
+        yield from entries
+        if len(entries) < config.HISTORY_EXPORT_PAGE_SIZE:
+            return
+        before = entries[-1]['id']
+
+def export_history_jsonl(filters):
+    for entry in iter_history(filters):
+        yield (json.dumps({
+            'id': entry['id'],
+            'email': entry['email'],
+            'timestamp': datetime.fromtimestamp(entry['created_at']).isoformat(),
+            'success': entry['success'],
+            'latex': entry['latex']
+        }, ensure_ascii=False) + '\n').encode('utf-8')
+
+def write_history_entry(archive, entry):
+    """把一条历史记录写成 ZIP 中的一个目录；图片先读出，读取失败时不会留下半条记录"""
+    created = datetime.fromtimestamp(entry['created_at'])
+    folder = f"{created.strftime('%Y%m%d_%H%M%S')}_{entry['id']}"
+    date_time = max(created, datetime(1980, 1, 1)).timetuple()[:6]
+    
+    data = history_store.get_image(entry['image_hash']) if entry['image_hash'] else None
+    metadata = json.dumps({
+        'email': entry['email'],
+        'timestamp': created.isoformat(),
+        'success': entry['success'],
+        'latex_length': len(entry['latex'])
+    }, ensure_ascii=False, indent=2)
+    if data:
+        try:
+            extension = Image.open(io.BytesIO(data)).format.lower()
+        except Exception:
+            extension = 'bin'
+        # 图片本身已压缩，直接存储
+        archive.writestr(zipfile.ZipInfo(f"{folder}/image.{extension}", date_time), data, zipfile.ZIP_STORED)
+    archive.writestr(zipfile.ZipInfo(f"{folder}/result.txt", date_time), entry['latex'], zipfile.ZIP_DEFLATED)
+    archive.writestr(zipfile.ZipInfo(f"{folder}/metadata.json", date_time), metadata, zipfile.ZIP_DEFLATED)
+
+def export_history_zip(filters):
+    """逐条写入 ZIP 并立即发送，每条记录一个目录 (与旧版 user_history 目录结构相同)
+    
+    响应头已发出，中途出错无法再返回错误状态：出错的记录跳过并写入 errors.txt，
+    查询中断时也照常写完目录区，保证下载到的 ZIP 可以打开
+    """
+    buffer = StreamBuffer()
+    errors = []
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        try:
+            for entry in iter_history(filters):
+                try:
+                    write_history_entry(archive, entry)
+                except Exception as e:
+                    logger.error(f"导出历史记录 {entry['id']} 失败: {e}")
+                    errors.append(f"记录 {entry['id']}: {e}")
+                yield buffer.take()
+        except Exception as e:
+            logger.error(f"导出历史记录中断: {e}")
+            errors.append(f"导出中断，之后的记录未导出: {e}")
+        if errors:
+            archive.writestr('errors.txt', '\n'.join(errors) + '\n', zipfile.ZIP_DEFLATED)
+    yield buffer.take()
+
+@app.route('/history/export')
+@login_required
+def history_export():
+    """导出历史记录：format=zip (图片 + LaTeX) 或 jsonl (仅结果)，筛选参数与 /history/entries 相同，边查询边发送"""
+    filters, error = parse_history_filters(request.args)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    export_format = request.args.get('format', 'zip')
+    if export_format not in ('zip', 'jsonl'):
+        return jsonify({'success': False, 'error': '导出格式应为 zip 或 jsonl'}), 400
+    
+    if export_format == 'zip':
+        body, mimetype = export_history_zip(filters), 'application/zip'
+    else:
+        body, mimetype = export_history_jsonl(filters), 'application/x-ndjson'
+    filename = f"history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    logger.info(f"History export ({export_format}) by {session['user_email']}")
+    return Response(body, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/history/<int:entry_id>/image')
+@login_required
+def history_image(entry_id):
+    entry = history_store.get_entry(entry_id)
+    if not can_view_history(entry) or not entry['image_hash']:
+        return jsonify({'success': False, 'error': '记录不存在'}), 404
+    data = history_store.get_image(entry['image_hash'])
+    if data is None:
+        return jsonify({'success': False, 'error': '图片不存在'}), 404
+    
+    try:
+        mime_type = Image.open(io.BytesIO(data)).get_format_mimetype() or 'application/octet-stream'
+    except Exception:
+        mime_type = 'application/octet-stream'
+    response = Response(data, mimetype=mime_type)
+    # 图片按内容哈希存储，内容不会变化
+    response.set_etag(entry['image_hash'])
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response.make_conditional(request)
+
 @app.route('/download_word', methods=['POST'])
 @login_required
 def download_word():
@@ -835,24 +4175,61 @@ def download_word():
         logger.error(f"生成Word文档失败: {e}")
         return jsonify({'success': False, 'error': f'生成Word文档失败: {str(e)}'})
 
+@app.route('/client_config')
+def client_config():
+    """前端图片压缩参数：浏览器上传前按此缩小并重新编码"""
+    return jsonify({
+        'image_max_size': config.CLIENT_IMAGE_MAX_SIZE,
+        'image_quality': config.IMAGE_QUALITY,
+        'reencode_bytes': config.CLIENT_REENCODE_BYTES,
+        'max_upload_bytes': config.MAX_CONTENT_LENGTH
+    })
+
 @app.route('/stats')
 def get_stats():
-    """获取统计信息"""
+    """获取统计信息（短时缓存，支持 If-None-Match 条件请求）"""
+    payload, etag = get_stats_snapshot()
+    response = jsonify(payload)
+    response.set_etag(etag)
+    # 浏览器每次轮询都带 If-None-Match 重新验证，内容未变时只返回 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/stats/details')
+@login_required
+def stats_details():
+    """各组件的运行统计 (本工作进程)：上游接口、缓存、限流、队列和历史记录，仅管理员可见"""
+    if g.user_role != 'admin':
+        return jsonify({'success': False, 'error': '需要管理员权限'}), 403
     return jsonify({
-        'total_conversions': get_conversion_count(),
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now().isoformat(),
+        'pid': os.getpid(),
+        'db_pool': db_pool.get_stats(),
+        'session_cache': session_cache.get_stats(),
+        'result_cache': result_cache.get_stats(),
+        'similar_cache': similar_index.get_stats(),
+        'adaptive_image': get_adaptive_stats(),
+        'providers': provider_router.get_stats(),
+        'upstream': upstream_stats.get_stats(),
+        'user_rate_limit': user_rate_stats.get_stats(),
+        'usage_events': usage_writer.get_stats(),
+        'history': history_store.get_stats(),
+        'history_writer': history_writer.get_stats(),
+        'history_maintenance': history_maintenance.get_stats(),
+        'single_flight': single_flight.get_stats(),
+        'jobs': job_manager.get_stats(),
+        'conversion_gate': conversion_gate.get_stats()
     })
 
 @app.route('/health')
 def health_check():
     """健康检查接口"""
     try:
-        config = get_api_config()
         return jsonify({
             'status': 'healthy', 
             'timestamp': datetime.now().isoformat(),
             'version': '1.0.0',
-            'api_configured': bool(config['api_key'])
+            'api_configured': bool(provider_router.providers)
         })
     except Exception as e:
         return jsonify({
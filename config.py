@@ -2,6 +2,7 @@
 # 项目配置文件
 # 所有敏感信息通过环境变量配置，便于安全部署
 import os
+import json
 
 # --- 数据库配置 ---
 # PostgreSQL 数据库连接信息 (通过环境变量配置)
@@ -14,6 +15,17 @@ DB_PASSWORD = os.getenv('DB_PASSWORD', '')  # 必须通过环境变量设置
 # 数据库连接字符串 (自动生成，无需修改)
 DB_URI = f"postgres://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# 数据库连接池配置 (每个工作进程一个连接池)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))                        # 最小连接数
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))                       # 最大连接数
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))                        # 借出连接最长等待时间（秒）
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', '30'))  # 空闲超过该秒数的连接在借出前检查
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))                    # 建立连接超时（秒）
+
+# 会话验证缓存 (角色变更/删除账户最迟在 TTL 秒后生效，设为 0 关闭缓存)
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', '60'))
+SESSION_CACHE_MAX_SIZE = int(os.getenv('SESSION_CACHE_MAX_SIZE', '10000'))
+
 
 # --- AI API 配置 ---
 # OpenAI API 密钥 (通过环境变量配置)
@@ -25,10 +37,38 @@ OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
 # 使用的模型名称
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o')
 
+# 多个 OpenAI 兼容接口 (JSON 数组)，每项可设置 name/api_base/api_key/model/weight/rpm/tpm，
+# 未设置的字段使用上面三项的值。例：
+# [{"name": "main", "weight": 3}, {"name": "backup", "api_base": "https://example.com/v1", "api_key": "sk-...", "weight": 1}]
+OPENAI_PROVIDERS = json.loads(os.getenv('OPENAI_PROVIDERS', '') or '[{"name": "default"}]')
+
+# 上游路由、对冲请求和熔断
+PROVIDER_LATENCY_WINDOW = int(os.getenv('PROVIDER_LATENCY_WINDOW', '200'))        # 每个接口保留的延迟样本数 (用于计算 p50/p95)
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'              # 首选接口超过其 p95 延迟时向另一接口再发一次
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '1'))                         # 发出对冲请求前的最短等待（秒）
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))       # 连续失败该次数后熔断
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))            # 熔断后经过该秒数放行一个探测请求
+
+# 上游失败重试 (429/5xx/网络错误，指数退避 + 随机抖动，遵循 Retry-After)
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', '3'))                  # 最多重试次数
+API_RETRY_BASE_DELAY = float(os.getenv('API_RETRY_BASE_DELAY', '0.5'))    # 退避基准时间（秒），第 n 次重试最多等待 base * 2^n
+API_RETRY_MAX_DELAY = float(os.getenv('API_RETRY_MAX_DELAY', '8'))        # 单次退避上限（秒）
+API_RETRY_MAX_WAIT = float(os.getenv('API_RETRY_MAX_WAIT', '30'))         # Retry-After 超过该秒数时不再重试
+
+# 上游配额限流 (所有工作进程共享，0 为不限；OPENAI_PROVIDERS 中可按接口设置 rpm/tpm)
+API_RPM_LIMIT = int(os.getenv('API_RPM_LIMIT', '0'))                      # 每分钟请求数
+API_TPM_LIMIT = int(os.getenv('API_TPM_LIMIT', '0'))                      # 每分钟 tokens 数
+API_THROTTLE_MAX_WAIT = float(os.getenv('API_THROTTLE_MAX_WAIT', '30'))   # 配额用尽时最长排队时间（秒）
+
 # 模型参数配置
 MODEL_MAX_TOKENS = int(os.getenv('MODEL_MAX_TOKENS', '1000'))
 MODEL_TEMPERATURE = float(os.getenv('MODEL_TEMPERATURE', '0.1'))
 
+# API 连接配置 (连接复用 keep-alive)
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '20'))                      # 每个进程到上游的最大空闲连接数
+API_CONNECT_TIMEOUT = float(os.getenv('API_CONNECT_TIMEOUT', '5'))         # 建立连接超时（秒）
+API_READ_TIMEOUT = float(os.getenv('API_READ_TIMEOUT', '60'))              # 等待响应超时（秒）
+
 
 # --- 其他应用配置 ---
 # Flask Secret Key (用于Session加密)
@@ -37,13 +77,120 @@ SECRET_KEY = os.getenv('SECRET_KEY', 'dev_secret_key_please_change_in_production
 # 图片处理配置
 IMAGE_MAX_SIZE = int(os.getenv('IMAGE_MAX_SIZE', '1024'))  # 图片最大尺寸（像素）
 IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '85'))      # 图片压缩质量 (1-100)
+IMAGE_TRIM_ENABLED = os.getenv('IMAGE_TRIM_ENABLED', 'true').lower() == 'true'  # 裁掉空白、只发送公式区域
+IMAGE_TRIM_PADDING = int(os.getenv('IMAGE_TRIM_PADDING', '16'))                  # 公式区域四周保留的空白（像素）
+IMAGE_INK_THRESHOLD = int(os.getenv('IMAGE_INK_THRESHOLD', '200'))               # 灰度低于该值视为墨迹
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', str(40 * 1000 * 1000)))    # 允许上传的最大像素数
+
+# 自适应图片压缩：按内容密度选择最小的可读分辨率、灰度/彩色和编码格式
+# 分辨率或 detail 被降低且模型返回"无法识别数学公式"时，自动以完整分辨率重试
+IMAGE_ADAPTIVE_ENABLED = os.getenv('IMAGE_ADAPTIVE_ENABLED', 'true').lower() == 'true'
+ADAPTIVE_MIN_STROKE = float(os.getenv('ADAPTIVE_MIN_STROKE', '2.0'))              # 缩放后笔画最小宽度（像素）
+ADAPTIVE_MIN_LINE_HEIGHT = float(os.getenv('ADAPTIVE_MIN_LINE_HEIGHT', '28'))     # 缩放后公式行最小高度（像素）
+ADAPTIVE_BASELINE_SAMPLE = int(os.getenv('ADAPTIVE_BASELINE_SAMPLE', '20'))        # 每 N 张图片编码一次基线 JPEG，抽样统计字节节省量
+
+# 浏览器端上传前压缩 (服务端仍会再次校验和优化)
+# 服务端会先裁掉空白再缩放到 IMAGE_MAX_SIZE，浏览器端保留两倍分辨率以免公式区域变模糊
+CLIENT_IMAGE_MAX_SIZE = int(os.getenv('CLIENT_IMAGE_MAX_SIZE', str(IMAGE_MAX_SIZE * 2)))  # 0 为不在浏览器端缩放
+CLIENT_REENCODE_BYTES = int(os.getenv('CLIENT_REENCODE_BYTES', str(1024 * 1024)))         # 尺寸未超限但超过该字节数时也重新编码
 
 # 上传文件配置
 MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', str(16 * 1024 * 1024)))  # 最大上传限制 16MB
 UPLOAD_FOLDER = 'uploads'
 USAGE_LOG_FILE = 'usage.log'
-STATS_FILE = 'conversion_stats.txt'
+USAGE_LOG_DISPLAY_LIMIT = int(os.getenv('USAGE_LOG_DISPLAY_LIMIT', '100'))                        # 首页显示的使用记录组数
+USAGE_LOG_BACKFILL_BYTES = int(os.getenv('USAGE_LOG_BACKFILL_BYTES', str(4 * 1024 * 1024)))     # 启动后首次读取使用日志末尾的字节数
+USAGE_LOG_MAX_BYTES = int(os.getenv('USAGE_LOG_MAX_BYTES', str(16 * 1024 * 1024)))             # 使用日志超过该大小后轮转，0 为不轮转
+USAGE_LOG_BACKUP_COUNT = int(os.getenv('USAGE_LOG_BACKUP_COUNT', '3'))                          # 保留的轮转文件数 (usage.log.1 ... usage.log.N)
+USAGE_EVENT_BATCH_SIZE = int(os.getenv('USAGE_EVENT_BATCH_SIZE', '200'))          # 使用事件攒够该条数立即写入
+USAGE_EVENT_FLUSH_INTERVAL = float(os.getenv('USAGE_EVENT_FLUSH_INTERVAL', '1'))   # 使用事件最长缓冲时间（秒）
+USAGE_EVENT_QUEUE_SIZE = int(os.getenv('USAGE_EVENT_QUEUE_SIZE', '10000'))        # 待写入事件上限，超出时丢弃
+STATS_FILE = 'conversion_stats.txt'    # 旧版转换次数文件，首次启动时导入 COUNTER_DB
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 
-# 用户历史记录文件夹 (保存用户上传的图片和AI返回的代码)
+# 本地数据目录 (SQLite 缓存/索引等，多个工作进程共享)
+DATA_FOLDER = os.getenv('DATA_FOLDER', 'data')
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))  # SQLite 锁等待时间（秒）
+
+# LaTeX 结果缓存 (按优化后图片内容+模型参数寻址)
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+RESULT_CACHE_MEMORY_SIZE = int(os.getenv('RESULT_CACHE_MEMORY_SIZE', '1024'))                     # 进程内 LRU 条目数
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))          # 磁盘缓存最大字节数
+RESULT_CACHE_DB = os.path.join(DATA_FOLDER, 'result_cache.db')
+
+# 相似图片缓存 (感知哈希，复用重新截图/重新压缩的同一公式的历史结果)
+# 默认关闭：dHash 区分不了只差一个上标、数字或符号的两个公式，开启后可能返回另一个公式的结果
+SIMILAR_CACHE_ENABLED = os.getenv('SIMILAR_CACHE_ENABLED', 'false').lower() == 'true'
+SIMILAR_CACHE_HASH_SIZE = int(os.getenv('SIMILAR_CACHE_HASH_SIZE', '16'))                  # dHash 边长，哈希位数为其平方
+SIMILAR_CACHE_MAX_DISTANCE = int(os.getenv('SIMILAR_CACHE_MAX_DISTANCE', '3'))             # 允许的最大汉明距离
+SIMILAR_CACHE_MAX_ASPECT_DIFF = float(os.getenv('SIMILAR_CACHE_MAX_ASPECT_DIFF', '0.1'))   # 内容区域宽高比最大相对差
+SIMILAR_CACHE_DB = os.path.join(DATA_FOLDER, 'similar_index.db')
+
+# 请求合并：并发的相同转换只调用一次模型，跨工作进程生效
+COALESCE_ENABLED = os.getenv('COALESCE_ENABLED', 'true').lower() == 'true'
+COALESCE_LEASE = float(os.getenv('COALESCE_LEASE', str((API_CONNECT_TIMEOUT + API_READ_TIMEOUT) * 2 + 10)))  # 领头请求最长持有时间（秒），超时后由等待者接替
+COALESCE_DB = os.path.join(DATA_FOLDER, 'inflight.db')
+
+# 令牌桶限流状态 (上游配额和用户配额)
+RATE_LIMIT_DB = os.path.join(DATA_FOLDER, 'rate_limit.db')
+
+# 结构化使用事件 (JSON Lines，按天分文件，之前日期的文件压缩为 .gz)
+USAGE_EVENTS_FOLDER = os.path.join(DATA_FOLDER, 'events')
+
+# 转换次数计数器
+COUNTER_DB = os.path.join(DATA_FOLDER, 'counters.db')
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', '5'))    # /stats 结果缓存时间（秒）
+
+# 用户转换频率限制 (每分钟转换次数，按 "user" 表中的角色区分，0 为不限；批量/PDF 按图片/页数计)
+USER_RATE_LIMIT = int(os.getenv('USER_RATE_LIMIT', '30'))     # 普通用户
+ADMIN_RATE_LIMIT = int(os.getenv('ADMIN_RATE_LIMIT', '0'))    # 管理员
+
+# 异步转换任务队列 (每个工作进程独立的队列和线程)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))                    # 后台转换线程数
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '100'))            # 队列最大长度，满时拒绝新任务
+JOB_MAX_PER_USER = int(os.getenv('JOB_MAX_PER_USER', '3'))          # 每个用户同时排队/执行的任务上限，0 为不限
+JOB_TIMEOUT = float(os.getenv('JOB_TIMEOUT', '300'))                # 任务超过该秒数未完成视为失败
+JOB_RESULT_TTL = float(os.getenv('JOB_RESULT_TTL', '3600'))         # 任务结果保留时间（秒）
+JOB_POLL_MAX_WAIT = float(os.getenv('JOB_POLL_MAX_WAIT', '25'))     # 长轮询最长等待时间（秒）
+JOB_DB = os.path.join(DATA_FOLDER, 'jobs.db')
+
+# 每个进程同时调用模型的转换数 (上传、流式、批量和任务队列共用，名额按用户轮转分配)，0 为不限
+CONVERSION_CONCURRENCY = int(os.getenv('CONVERSION_CONCURRENCY', '8'))
+CONVERSION_QUEUE_TIMEOUT = float(os.getenv('CONVERSION_QUEUE_TIMEOUT', '60'))   # 排队等待名额的最长时间 (秒)
+
+# 批量转换
+BATCH_MAX_IMAGES = int(os.getenv('BATCH_MAX_IMAGES', '20'))         # 单次批量转换最多图片数
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))        # 单次批量转换同时调用模型的数量
+
+# PDF 转换
+PDF_RENDER_DPI = int(os.getenv('PDF_RENDER_DPI', '150'))            # 栅格化分辨率
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '50'))               # 单个PDF最多页数
+PDF_CONCURRENCY = int(os.getenv('PDF_CONCURRENCY', '4'))            # 同时识别的页数
+
+# 用户历史记录 (SQLite 索引 + 按内容去重的只追加 pack 文件)
+HISTORY_DB = os.path.join(DATA_FOLDER, 'history.db')
+HISTORY_PACK_FOLDER = os.path.join(DATA_FOLDER, 'history_packs')
+HISTORY_PACK_MAX_BYTES = int(os.getenv('HISTORY_PACK_MAX_BYTES', str(256 * 1024 * 1024)))   # 单个 pack 文件达到该大小后新建下一个
+
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))    # /history/entries 默认每页条数
+HISTORY_PAGE_MAX = int(os.getenv('HISTORY_PAGE_MAX', '200'))     # /history/entries 每页条数上限
+
+HISTORY_WRITE_BATCH_SIZE = int(os.getenv('HISTORY_WRITE_BATCH_SIZE', '20'))             # 历史记录后台批量写入条数
+HISTORY_WRITE_FLUSH_INTERVAL = float(os.getenv('HISTORY_WRITE_FLUSH_INTERVAL', '0.5'))   # 历史记录攒批最长等待时间 (秒)
+HISTORY_WRITE_QUEUE_SIZE = int(os.getenv('HISTORY_WRITE_QUEUE_SIZE', '200'))             # 每个进程待写入历史记录上限 (含图片，注意内存)
+HISTORY_ENQUEUE_TIMEOUT = float(os.getenv('HISTORY_ENQUEUE_TIMEOUT', '2'))               # 队列满时请求最多等待的时间 (秒)，超时丢弃该记录
+
+HISTORY_EXPORT_PAGE_SIZE = int(os.getenv('HISTORY_EXPORT_PAGE_SIZE', '200'))  # 导出时每次从索引读取的记录数
+
+# 历史记录保留策略：LaTeX 结果永久保留，原图超过保留天数后替换为缩略图 (0 为永久保留原图)
+HISTORY_ORIGINAL_DAYS = int(os.getenv('HISTORY_ORIGINAL_DAYS', '30'))                # 普通用户原图保留天数
+HISTORY_ADMIN_ORIGINAL_DAYS = int(os.getenv('HISTORY_ADMIN_ORIGINAL_DAYS', '0'))     # 管理员原图保留天数
+HISTORY_THUMBNAIL_MAX_SIZE = int(os.getenv('HISTORY_THUMBNAIL_MAX_SIZE', '480'))     # 缩略图最长边 (像素)
+HISTORY_THUMBNAIL_QUALITY = int(os.getenv('HISTORY_THUMBNAIL_QUALITY', '70'))        # 缩略图 JPEG/WebP 质量
+HISTORY_MAINTENANCE_INTERVAL = int(os.getenv('HISTORY_MAINTENANCE_INTERVAL', '60'))  # 维护任务间隔 (秒，0 为关闭)
+HISTORY_MAINTENANCE_BATCH = int(os.getenv('HISTORY_MAINTENANCE_BATCH', '100'))       # 每轮最多处理的原图数
+HISTORY_COMPACT_BYTES = int(os.getenv('HISTORY_COMPACT_BYTES', str(32 * 1024 * 1024)))   # 每轮压缩 pack 最多移动的字节数
+HISTORY_COMPACT_LIVE_RATIO = float(os.getenv('HISTORY_COMPACT_LIVE_RATIO', '0.5'))   # pack 有效数据比例低于该值时压缩
+
+# 旧版用户历史记录文件夹 (每次转换一个目录，migrate_history.py 从这里导入)
 USER_HISTORY_FOLDER = os.getenv('USER_HISTORY_FOLDER', 'user_history')
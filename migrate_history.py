@@ -0,0 +1,91 @@
+"""
+将旧版 user_history/{用户}/{时间戳}/ 目录中的历史记录导入 SQLite 索引和 pack 文件
+
+用法:
+    python migrate_history.py            # 导入 (可重复执行，已导入的目录会跳过)
+    python migrate_history.py --delete   # 导入后删除已导入的旧目录
+"""
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime
+
+import config
+from app import HistoryStore
+
+def load_entry(entry_path):
+    """读取一个旧版历史目录，返回 (email, created_at, success, latex, image_data)；无法识别时返回 None"""
+    metadata_path = os.path.join(entry_path, "metadata.json")
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    email = metadata.get("email")
+    if not email:
+        return None
+
+    try:
+        created_at = datetime.fromisoformat(metadata["timestamp"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        created_at = datetime.strptime(os.path.basename(entry_path), "%Y%m%d_%H%M%S_%f").timestamp()
+
+    latex = "无结果"
+    result_path = os.path.join(entry_path, "result.txt")
+    if os.path.exists(result_path):
+        with open(result_path, 'r', encoding='utf-8') as f:
+            latex = f.read()
+
+    image_data = None
+    image_path = os.path.join(entry_path, "image.png")
+    if os.path.exists(image_path):
+        with open(image_path, 'rb') as f:
+            image_data = f.read()
+
+    return email, created_at, bool(metadata.get("success")), latex, image_data
+
+def migrate_history(delete=False):
+    store = HistoryStore(config.HISTORY_DB, config.HISTORY_PACK_FOLDER, config.HISTORY_PACK_MAX_BYTES)
+    root = config.USER_HISTORY_FOLDER
+    if not os.path.isdir(root):
+        print(f"旧版历史记录目录不存在: {root}")
+        return
+
+    imported = skipped = failed = 0
+    for user in sorted(os.listdir(root)):
+        user_path = os.path.join(root, user)
+        if not os.path.isdir(user_path):
+            continue
+        for name in sorted(os.listdir(user_path)):
+            entry_path = os.path.join(user_path, name)
+            if not os.path.isdir(entry_path):
+                continue
+            legacy_path = f"{user}/{name}"
+            try:
+                entry = load_entry(entry_path)
+                if entry is None:
+                    print(f"跳过 {legacy_path}: 缺少 metadata.json 或邮箱")
+                    failed += 1
+                    continue
+                email, created_at, success, latex, image_data = entry
+                if store.add(email, image_data, latex, success, created_at=created_at, legacy_path=legacy_path) is None:
+                    skipped += 1
+                else:
+                    imported += 1
+            except Exception as e:
+                print(f"导入 {legacy_path} 失败: {e}")
+                failed += 1
+                continue
+            if delete:
+                shutil.rmtree(entry_path)
+        if delete and not os.listdir(user_path):
+            os.rmdir(user_path)
+
+    print(f"导入 {imported} 条，已存在 {skipped} 条，失败 {failed} 条")
+    print(f"去重图片 {store.get_stats()['dedup_hits']} 张")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="导入旧版用户历史记录目录")
+    parser.add_argument('--delete', action='store_true', help="导入成功后删除旧目录")
+    args = parser.parse_args()
+    migrate_history(delete=args.delete)
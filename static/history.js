@@ -0,0 +1,98 @@
+class HistoryBrowser {
+    constructor() {
+        this.form = document.getElementById('historyFilters');
+        this.list = document.getElementById('historyList');
+        this.loadMoreBtn = document.getElementById('loadMoreBtn');
+        this.emptyHint = document.getElementById('historyEmpty');
+        this.errorMessage = document.getElementById('errorMessage');
+        this.nextBefore = null;
+
+        this.form.addEventListener('submit', (e) => {
+            e.preventDefault();
+            this.reload();
+        });
+        this.loadMoreBtn.addEventListener('click', () => this.loadPage());
+        this.form.querySelectorAll('[data-export]').forEach(button => {
+            button.addEventListener('click', () => this.exportHistory(button.dataset.export));
+        });
+        this.reload();
+    }
+
+    reload() {
+        this.list.innerHTML = '';
+        this.nextBefore = null;
+        this.loadPage();
+    }
+
+    filterParams() {
+        const params = new URLSearchParams();
+        for (const [key, value] of new FormData(this.form)) {
+            if (value) params.set(key, value);
+        }
+        return params;
+    }
+
+    exportHistory(format) {
+        // 浏览器直接下载流式响应，不在页面中缓存
+        const params = this.filterParams();
+        params.set('format', format);
+        window.location.href = '/history/export?' + params.toString();
+    }
+
+    async loadPage() {
+        const params = this.filterParams();
+        if (this.nextBefore) params.set('before', this.nextBefore);
+
+        this.loadMoreBtn.disabled = true;
+        try {
+            const response = await fetch('/history/entries?' + params.toString());
+            const data = await response.json();
+            if (!data.success) {
+                this.showError(data.error || '查询失败');
+                return;
+            }
+            this.errorMessage.style.display = 'none';
+            data.entries.forEach(entry => this.list.appendChild(this.renderEntry(entry)));
+            this.nextBefore = data.next_before;
+            this.loadMoreBtn.style.display = this.nextBefore ? 'inline-flex' : 'none';
+            this.emptyHint.style.display = this.list.children.length ? 'none' : 'block';
+        } catch (error) {
+            this.showError('网络错误: ' + error.message);
+        } finally {
+            this.loadMoreBtn.disabled = false;
+        }
+    }
+
+    renderEntry(entry) {
+        const item = document.createElement('div');
+        item.className = 'batch-item' + (entry.success ? '' : ' batch-error');
+
+        const title = document.createElement('div');
+        title.className = 'batch-item-title';
+        const time = entry.created_at.replace('T', ' ').slice(0, 19);
+        title.textContent = `${time} · ${entry.email} · ${entry.success ? '成功' : '失败'}`;
+        item.appendChild(title);
+
+        if (entry.has_image) {
+            const img = document.createElement('img');
+            img.className = 'history-image';
+            img.loading = 'lazy';
+            img.src = `/history/${entry.id}/image`;
+            img.alt = '上传的图片';
+            item.appendChild(img);
+        }
+
+        const textarea = document.createElement('textarea');
+        textarea.readOnly = true;
+        textarea.value = entry.latex;
+        item.appendChild(textarea);
+        return item;
+    }
+
+    showError(message) {
+        this.errorMessage.textContent = message;
+        this.errorMessage.style.display = 'block';
+    }
+}
+
+document.addEventListener('DOMContentLoaded', () => new HistoryBrowser());
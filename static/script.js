@@ -4,6 +4,18 @@ class MathOCR {
         this.bindEvents();
         this.currentImage = null;
         this.currentLatex = null;
+        // 服务端图片参数，加载失败时使用默认值（不在客户端压缩）
+        this.clientConfig = { image_max_size: 0, image_quality: 85, reencode_bytes: 0, max_upload_bytes: 16 * 1024 * 1024 };
+        this.loadClientConfig();
+    }
+
+    async loadClientConfig() {
+        try {
+            const response = await fetch('/client_config');
+            this.clientConfig = Object.assign(this.clientConfig, await response.json());
+        } catch (error) {
+            console.log('获取图片参数失败:', error);
+        }
     }
 
     initializeElements() {
@@ -22,6 +34,9 @@ class MathOCR {
         this.btnText = document.querySelector('.btn-text');
         this.loading = document.querySelector('.loading');
         this.totalCount = document.getElementById('totalCount');
+        this.batchSection = document.getElementById('batchSection');
+        this.batchResults = document.getElementById('batchResults');
+        this.batchProgress = document.getElementById('batchProgress');
     }
 
     bindEvents() {
@@ -45,9 +60,11 @@ class MathOCR {
     }
 
     handleFileSelect(event) {
-        const file = event.target.files[0];
-        if (file) {
-            this.processFile(file);
+        const files = event.target.files;
+        if (files.length > 1) {
+            this.processBatch(Array.from(files));
+        } else if (files.length === 1) {
+            this.processFile(files[0]);
         }
     }
 
@@ -66,7 +83,9 @@ class MathOCR {
         this.uploadArea.classList.remove('dragover');
         
         const files = event.dataTransfer.files;
-        if (files.length > 0) {
+        if (files.length > 1) {
+            this.processBatch(Array.from(files));
+        } else if (files.length > 0) {
             this.processFile(files[0]);
         }
     }
@@ -82,7 +101,12 @@ class MathOCR {
         }
     }
 
-    processFile(file) {
+    async processFile(file) {
+        if (file.type === 'application/pdf') {
+            this.processPdf(file);
+            return;
+        }
+
         // 检查文件类型
         const allowedTypes = ['image/png', 'image/jpeg', 'image/jpg', 'image/gif', 'image/bmp', 'image/webp'];
         if (!allowedTypes.includes(file.type)) {
@@ -90,18 +114,205 @@ class MathOCR {
             return;
         }
 
+        // 在浏览器中先缩小/重新编码，减少上传流量
+        const image = await this.shrinkImage(file);
+
         // 检查文件大小 (16MB)
-        if (file.size > 16 * 1024 * 1024) {
+        if (image.size > this.clientConfig.max_upload_bytes) {
             this.showError('文件太大，请上传小于16MB的图片');
             return;
         }
 
-        const reader = new FileReader();
-        reader.onload = (e) => {
-            this.currentImage = e.target.result;
-            this.showPreview(e.target.result);
-        };
-        reader.readAsDataURL(file);
+        // 直接保留文件 (Blob)，以二进制上传，避免 base64 编码
+        this.setCurrentImage(image);
+    }
+
+    async shrinkImage(file) {
+        const maxSize = this.clientConfig.image_max_size;
+        if (!maxSize || !window.createImageBitmap) {
+            return file;
+        }
+
+        let bitmap;
+        try {
+            bitmap = await createImageBitmap(file);
+        } catch (error) {
+            // 浏览器无法解码的格式原样上传，由服务端处理
+            return file;
+        }
+
+        const scale = Math.min(1, maxSize / Math.max(bitmap.width, bitmap.height));
+        if (scale === 1 && file.size <= this.clientConfig.reencode_bytes) {
+            bitmap.close();
+            return file;
+        }
+
+        const canvas = document.createElement('canvas');
+        canvas.width = Math.max(1, Math.round(bitmap.width * scale));
+        canvas.height = Math.max(1, Math.round(bitmap.height * scale));
+        const context = canvas.getContext('2d');
+        // 透明背景填充白色，避免转为 JPEG 后变黑
+        context.fillStyle = '#ffffff';
+        context.fillRect(0, 0, canvas.width, canvas.height);
+        context.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+        bitmap.close();
+
+        const blob = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', this.clientConfig.image_quality / 100));
+        if (!blob || blob.size >= file.size) {
+            return file;
+        }
+        const name = (file.name || 'image').replace(/\.[^.]+$/, '') + '.jpg';
+        return new File([blob], name, { type: 'image/jpeg' });
+    }
+
+    setCurrentImage(blob) {
+        if (this.previewUrl) {
+            URL.revokeObjectURL(this.previewUrl);
+        }
+        this.currentImage = blob;
+        this.previewUrl = URL.createObjectURL(blob);
+        this.showPreview(this.previewUrl);
+    }
+
+    async processBatch(files) {
+        const allowedTypes = ['image/png', 'image/jpeg', 'image/jpg', 'image/gif', 'image/bmp', 'image/webp'];
+        const validFiles = files.filter(file => allowedTypes.includes(file.type));
+        if (validFiles.length === 0) {
+            this.showError('没有可转换的图片，请上传小于16MB的图片文件');
+            return;
+        }
+
+        // 在浏览器中先缩小/重新编码，再检查大小：单张和整个请求都不能超过上传上限
+        const images = await Promise.all(validFiles.map(file => this.shrinkImage(file)));
+        const maxBytes = this.clientConfig.max_upload_bytes;
+        if (images.some(image => image.size > maxBytes)) {
+            this.showError('文件太大，请上传小于16MB的图片');
+            return;
+        }
+        if (images.reduce((total, image) => total + image.size, 0) > maxBytes) {
+            this.showError('图片总大小超过16MB，请分批上传');
+            return;
+        }
+
+        this.hideError();
+        this.batchResults.innerHTML = '';
+        this.batchSection.style.display = 'block';
+        const items = validFiles.map((file, index) => this.createBatchItem(index, file.name));
+        let finished = 0;
+        this.batchProgress.textContent = `(0/${validFiles.length})`;
+        this.batchSection.scrollIntoView({ behavior: 'smooth' });
+
+        try {
+            // 以 multipart 直接上传文件，避免 base64 膨胀
+            const formData = new FormData();
+            images.forEach(image => formData.append('files', image, image.name));
+            const response = await fetch('/upload_batch?stream=1', {
+                method: 'POST',
+                body: formData
+            });
+
+            const contentType = response.headers.get('Content-Type') || '';
+            if (!contentType.includes('text/event-stream')) {
+                const result = await response.json();
+                this.showError(result.error || '批量转换失败，请重试');
+                return;
+            }
+
+            await this.readEventStream(response, (eventName, payload) => {
+                if (eventName !== 'item') return;
+                this.fillBatchItem(items[payload.index], payload.result);
+                finished += 1;
+                this.batchProgress.textContent = `(${finished}/${validFiles.length})`;
+                if (payload.result.total_conversions) {
+                    this.updateConversionCount(payload.result.total_conversions);
+                }
+            });
+        } catch (error) {
+            this.showError('网络错误，请检查连接后重试');
+            console.error('批量转换错误:', error);
+        }
+    }
+
+    async processPdf(file) {
+        if (file.size > 16 * 1024 * 1024) {
+            this.showError('文件太大，请上传小于16MB的PDF');
+            return;
+        }
+
+        this.hideError();
+        this.batchResults.innerHTML = '';
+        this.batchSection.style.display = 'block';
+        this.batchProgress.textContent = '(正在读取PDF...)';
+        this.batchSection.scrollIntoView({ behavior: 'smooth' });
+
+        let items = [];
+        let finished = 0;
+        try {
+            const formData = new FormData();
+            formData.append('file', file, file.name);
+            const response = await fetch('/upload', {
+                method: 'POST',
+                body: formData
+            });
+
+            const contentType = response.headers.get('Content-Type') || '';
+            if (!contentType.includes('text/event-stream')) {
+                const result = await response.json();
+                this.showError(result.error || 'PDF转换失败，请重试');
+                return;
+            }
+
+            await this.readEventStream(response, (eventName, payload) => {
+                if (eventName === 'start') {
+                    items = Array.from({ length: payload.pages }, (_, i) => this.createBatchItem(i, `${file.name} 第 ${i + 1} 页`));
+                    this.batchProgress.textContent = `(0/${payload.pages})`;
+                } else if (eventName === 'page') {
+                    this.fillBatchItem(items[payload.index], payload.result);
+                    finished += 1;
+                    this.batchProgress.textContent = `(${finished}/${items.length})`;
+                    if (payload.result.total_conversions) {
+                        this.updateConversionCount(payload.result.total_conversions);
+                    }
+                } else if (eventName === 'done' && !payload.success) {
+                    this.showError(payload.error || 'PDF转换失败，请重试');
+                }
+            });
+        } catch (error) {
+            this.showError('网络错误，请检查连接后重试');
+            console.error('PDF转换错误:', error);
+        }
+    }
+
+    createBatchItem(index, name) {
+        const item = document.createElement('div');
+        item.className = 'batch-item';
+        const title = document.createElement('div');
+        title.className = 'batch-item-title';
+        title.textContent = `图片 ${index + 1}: ${name}`;
+        const textarea = document.createElement('textarea');
+        textarea.readOnly = true;
+        textarea.placeholder = '转换中...';
+        const preview = document.createElement('div');
+        preview.className = 'batch-preview';
+        item.append(title, textarea, preview);
+        this.batchResults.appendChild(item);
+        return item;
+    }
+
+    fillBatchItem(item, result) {
+        const textarea = item.querySelector('textarea');
+        const preview = item.querySelector('.batch-preview');
+        if (result.success) {
+            textarea.value = result.latex;
+            preview.textContent = result.latex;
+            if (window.MathJax) {
+                MathJax.typesetPromise([preview]).catch((err) => console.log('MathJax渲染错误:', err));
+            }
+        } else {
+            item.classList.add('batch-error');
+            textarea.value = '';
+            preview.textContent = result.error || '转换失败';
+        }
     }
 
     showPreview(imageSrc) {
@@ -115,6 +326,10 @@ class MathOCR {
     }
 
     clearImage() {
+        if (this.previewUrl) {
+            URL.revokeObjectURL(this.previewUrl);
+            this.previewUrl = null;
+        }
         this.currentImage = null;
         this.currentLatex = null;
         this.previewSection.style.display = 'none';
@@ -134,17 +349,10 @@ class MathOCR {
         this.hideError();
 
         try {
-            const response = await fetch('/upload_base64', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    image: this.currentImage
-                })
-            });
-
-            const result = await response.json();
+            // 优先使用流式接口，边生成边显示；浏览器不支持时退回任务队列
+            const result = (window.ReadableStream && window.TextDecoder)
+                ? await this.convertStreaming(this.currentImage)
+                : await this.convertWithJob(this.currentImage);
             
             if (result.success) {
                 this.currentLatex = result.latex;
@@ -164,13 +372,116 @@ class MathOCR {
         }
     }
 
-    showResult(latex) {
+    async convertStreaming(image) {
+        const response = await fetch('/upload_stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': image.type || 'application/octet-stream',
+            },
+            body: image
+        });
+
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!contentType.includes('text/event-stream') || !response.body) {
+            return await response.json();
+        }
+
+        let finalResult = { success: false, error: '连接中断，请重试' };
+        await this.readEventStream(response, (eventName, payload) => {
+            if (eventName === 'delta') {
+                this.showResult(payload.latex, true);
+            } else if (eventName === 'done') {
+                finalResult = payload;
+            }
+        });
+        return finalResult;
+    }
+
+    async readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // SSE 事件以空行分隔
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let eventName = 'message';
+                let data = '';
+                for (const line of rawEvent.split('\n')) {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                }
+                if (data) {
+                    onEvent(eventName, JSON.parse(data));
+                }
+            }
+        }
+    }
+
+    async convertWithJob(image) {
+        // 提交异步任务，然后长轮询获取结果
+        const submitResponse = await fetch('/jobs', {
+            method: 'POST',
+            headers: {
+                'Content-Type': image.type || 'application/octet-stream',
+            },
+            body: image
+        });
+
+        const job = await submitResponse.json();
+        if (!job.success) {
+            return job;
+        }
+        return await this.waitForJob(job.job_id);
+    }
+
+    async waitForJob(jobId) {
+        while (true) {
+            const response = await fetch(`/jobs/${jobId}?wait=25`);
+            const job = await response.json();
+            if (!job.success) {
+                return { success: false, error: job.error };
+            }
+            if (job.status === 'finished') {
+                return job.result;
+            }
+        }
+    }
+
+    showResult(latex, partial = false) {
+        const firstShow = this.resultSection.style.display !== 'block';
         this.latexResult.value = latex;
         this.resultSection.style.display = 'block';
-        this.updateMathPreview(latex);
+
+        if (partial) {
+            this.schedulePreview(latex);
+        } else {
+            clearTimeout(this.previewTimer);
+            this.previewTimer = null;
+            this.updateMathPreview(latex);
+        }
         
         // 滚动到结果区域
-        this.resultSection.scrollIntoView({ behavior: 'smooth' });
+        if (!partial || firstShow) {
+            this.resultSection.scrollIntoView({ behavior: 'smooth' });
+        }
+    }
+
+    schedulePreview(latex) {
+        // 流式输出时限制 MathJax 重新渲染频率
+        this.pendingPreview = latex;
+        if (this.previewTimer) return;
+        this.previewTimer = setTimeout(() => {
+            this.previewTimer = null;
+            this.updateMathPreview(this.pendingPreview);
+        }, 200);
     }
 
     updateMathPreview(latex) {
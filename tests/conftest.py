@@ -0,0 +1,103 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# app 在导入时读取配置并在当前目录创建 data/ 等文件，先切换到临时目录
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='math-ocr-tests-'))
+os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+os.environ.setdefault('OPENAI_API_BASE', 'http://127.0.0.1:9')
+
+import app  # noqa: E402
+
+
+class StubUpstream:
+    """本地的 OpenAI 兼容接口：按 status/delay/reply 返回 /chat/completions 响应"""
+
+    def __init__(self, status=200, delay=0.0, reply='$$x^2$$'):
+        self.status = status
+        self.delay = delay
+        self.reply = reply
+        self.requests = 0
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                upstream.requests += 1
+                time.sleep(upstream.delay)
+                body = json.dumps({
+                    'choices': [{'message': {'content': upstream.reply}}],
+                    'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+                }).encode('utf-8')
+                try:
+                    self.send_response(upstream.status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    # 客户端已超时断开
+                    pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def api_base(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def provider(self, name):
+        """指向本桩接口的上游接口配置 (与 load_providers 的格式相同)"""
+        return {
+            'name': name,
+            'api_base': self.api_base,
+            'api_key': 'test-key',
+            'model': f'model-{name}',
+            'weight': 1.0,
+            'rpm': 0,
+            'tpm': 0
+        }
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def upstreams():
+    """创建若干个桩接口，测试结束后关闭"""
+    created = []
+
+    def create(**kwargs):
+        upstream = StubUpstream(**kwargs)
+        created.append(upstream)
+        return upstream
+
+    yield create
+    for upstream in created:
+        upstream.close()
+
+
+@pytest.fixture
+def route(monkeypatch):
+    """用给定的接口替换全局路由；总是按顺序选择第一个可用接口"""
+    monkeypatch.setattr(app.random, 'choices', lambda candidates, weights: [candidates[0]])
+
+    def install(*providers, failure_threshold=3):
+        router = app.ProviderRouter(list(providers), window=50, failure_threshold=failure_threshold, reset_timeout=60)
+        monkeypatch.setattr(app, 'provider_router', router)
+        return router
+
+    return install
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+import app
+
+
+def make_prepared():
+    return {'mime_type': 'image/png', 'optimized_image': 'aGVsbG8=', 'detail': 'low', 'tokens': 100}
+
+
+@pytest.fixture
+def api_config():
+    return dict(app.get_api_config(), connect_timeout=1, read_timeout=2, max_retries=0, hedge_enabled=False)
+
+
+def provider_state(router, name):
+    return router._state[name]
+
+
+def test_breaker_opens_after_server_errors(upstreams, route, api_config):
+    provider = upstreams(status=503).provider('a')
+    router = route(provider)
+
+    for _ in range(3):
+        latex, error, retry_after = app.call_provider(provider, api_config, make_prepared())
+        assert latex is None and '503' in error
+        assert retry_after == 0
+
+    state = provider_state(router, 'a')
+    assert state['circuit'] == 'open'
+    assert state['failures'] == 3
+    # 失败请求的耗时不进入延迟样本
+    assert len(state['latencies']) == 0
+    assert router.choose() is None
+
+
+def test_breaker_opens_after_timeouts(upstreams, route, api_config):
+    provider = upstreams(delay=1.0).provider('a')
+    router = route(provider)
+    api_config['read_timeout'] = 0.1
+
+    for _ in range(3):
+        latex, error, retry_after = app.call_provider(provider, api_config, make_prepared())
+        assert latex is None and error
+        assert retry_after == 0
+
+    assert provider_state(router, 'a')['circuit'] == 'open'
+    assert router.choose() is None
+
+
+def test_bad_request_does_not_count_against_provider(upstreams, route, api_config):
+    provider = upstreams(status=400).provider('a')
+    router = route(provider, failure_threshold=1)
+
+    latex, error, retry_after = app.call_provider(provider, api_config, make_prepared())
+
+    assert latex is None and '400' in error
+    # 请求本身的问题不重试
+    assert retry_after is None
+    state = provider_state(router, 'a')
+    assert state['requests'] == 1
+    assert state['failures'] == 0
+    assert state['circuit'] == 'closed'
+    assert len(state['latencies']) == 0
+
+
+def test_auth_error_fails_over_to_next_provider(upstreams, route, api_config):
+    broken = upstreams(status=401)
+    healthy = upstreams(reply='$$a+b$$')
+    router = route(broken.provider('a'), healthy.provider('b'))
+    api_config.update(max_retries=1, retry_base_delay=0.01)
+    prepared = make_prepared()
+
+    latex, error = app.request_completion(api_config, prepared)
+
+    assert error is None
+    assert latex == '$$a+b$$'
+    assert broken.requests == 1 and healthy.requests == 1
+    assert provider_state(router, 'a')['failures'] == 1
+    assert prepared['provider'] == 'b'
+
+
+def test_hedge_uses_first_success(upstreams, route, api_config):
+    slow = upstreams(delay=1.0, reply='$$slow$$')
+    fast = upstreams(reply='$$fast$$')
+    router = route(slow.provider('a'), fast.provider('b'))
+    # 首选接口的 p95 很短，超过后立即对冲
+    for _ in range(router.min_samples):
+        router.record(router.providers[0], True, 0.01)
+    api_config.update(hedge_enabled=True, hedge_min_delay=0.05)
+    prepared = make_prepared()
+
+    started = time.monotonic()
+    latex, error, retry_after = app.send_completion(api_config, prepared)
+
+    assert (latex, error) == ('$$fast$$', None)
+    assert time.monotonic() - started < 0.9
+    assert prepared['provider'] == 'b' and prepared['model'] == 'model-b'
+    assert provider_state(router, 'b')['hedge_wins'] == 1
@@ -0,0 +1,56 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+import app
+
+
+def render_power(exponent):
+    """渲染 "x^2+y^2=z" 加上标 exponent 的公式截图，放大 4 倍模拟屏幕截图"""
+    text = 'x^2+y^2=z'
+    font = ImageFont.load_default()
+    img = Image.new('L', (len(text) * 6 + 20, 24), 255)
+    draw = ImageDraw.Draw(img)
+    draw.text((4, 8), text, fill=0, font=font)
+    draw.text((4 + len(text) * 6, 2), exponent, fill=0, font=font)
+    output = io.BytesIO()
+    img.resize((img.width * 4, img.height * 4), Image.Resampling.NEAREST).save(output, format='PNG')
+    return app.UploadedImage(data=output.getvalue())
+
+
+@pytest.fixture
+def fresh_caches(monkeypatch, tmp_path):
+    """每个测试使用空的结果缓存和相似图片索引"""
+    monkeypatch.setattr(app, 'result_cache', app.ResultCache(str(tmp_path / 'result_cache.db'), 16, 1024 * 1024))
+    monkeypatch.setattr(app, 'similar_index', app.SimilarImageIndex(
+        str(tmp_path / 'similar_index.db'),
+        max_distance=app.config.SIMILAR_CACHE_MAX_DISTANCE,
+        hash_bits=app.config.SIMILAR_CACHE_HASH_SIZE ** 2,
+        max_aspect_diff=app.config.SIMILAR_CACHE_MAX_ASPECT_DIFF
+    ))
+
+
+def test_similar_cache_is_off_by_default():
+    assert app.config.SIMILAR_CACHE_ENABLED is False
+
+
+def test_superscript_change_is_within_dhash_distance():
+    """这两张图片的 dHash 足够接近，相似图片缓存开启时会被当作同一公式"""
+    api_config = dict(app.get_api_config(), similar_cache_enabled=True)
+    first = app.prepare_conversion(render_power('2'), api_config)['dhash']
+    second = app.prepare_conversion(render_power('3'), api_config)['dhash']
+    assert bin(first[0] ^ second[0]).count('1') <= app.config.SIMILAR_CACHE_MAX_DISTANCE
+
+
+def test_formulas_differing_in_one_superscript_both_miss(upstreams, route, fresh_caches):
+    upstream = upstreams(reply='$$x^2+y^2=z^2$$')
+    route(upstream.provider('a'))
+
+    first = app.call_ai_api(render_power('2'))
+    upstream.reply = '$$x^2+y^2=z^3$$'
+    second = app.call_ai_api(render_power('3'))
+
+    assert upstream.requests == 2
+    assert first['latex'] == '$$x^2+y^2=z^2$$' and not first['cached']
+    assert second['latex'] == '$$x^2+y^2=z^3$$' and not second['cached']